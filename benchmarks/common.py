@@ -0,0 +1,71 @@
+"""
+Helpers shared by the benchmarks: test images and payloads, timing and the printing
+of the results. Each benchmark module defines `COLUMNS` and a `benchmark(number)`
+generator of (case, timings) pairs, where `case` is an ordered dict describing the
+inputs and `timings` are in milliseconds, in the order of `COLUMNS`.
+"""
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+import utils
+from draw_test import tagging_payload
+from fakes import make_detection_payload
+
+# --------------------------------------------------------------------------- #
+
+RESOLUTIONS = OrderedDict([
+    ('720p', (1280, 720)),
+    ('1080p', (1920, 1080)),
+    ('4K', (3840, 2160)),
+])
+
+BOX_COUNTS = (1, 10, 100, 500)
+SMALL_BOX_COUNTS = (10, 100)  # Small boxes spread out on the whole frame
+
+def load_test_image(size, filename='dog.jpg'):
+    path = os.path.join(os.path.dirname(__file__), '..', 'tests', filename)
+    return Image.open(path).convert('RGB').resize(size)
+
+def make_test_frame(size, filename='screenshot.jpg'):
+    return utils.dump(load_test_image(size, filename))
+
+def get_payloads(box_counts=BOX_COUNTS, small_box_counts=SMALL_BOX_COUNTS):
+    payloads = OrderedDict([('tagging', tagging_payload)])
+    for n_boxes in box_counts:
+        payloads['{} boxes'.format(n_boxes)] = make_detection_payload(n_boxes)
+    for n_boxes in small_box_counts:
+        payloads['{} small boxes'.format(n_boxes)] = make_detection_payload(n_boxes, max_size=0.1)
+    return payloads
+
+def time_ms(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+
+# --------------------------------------------------------------------------- #
+
+def print_table(columns, rows):
+    """
+    Print the (case, timings) rows of a benchmark as they come
+    """
+    header = None
+    for case, timings in rows:
+        if header is None:
+            header = list(case)
+            widths = [max(len(k), 10) for k in header]
+            print(' '.join('{:<{}}'.format(k, w) for k, w in zip(header, widths)) +
+                  ''.join(' {:>14}'.format(c) for c in columns))
+        print(' '.join('{:<{}}'.format(str(v), w) for v, w in zip(case.values(), widths)) +
+              ''.join(' {:>11.3f} ms'.format(t) for t in timings))
+        sys.stdout.flush()
+
+def main(module, default_number):
+    """
+    Command line of a single benchmark: python benchmarks/<name>_benchmark.py [number of runs]
+    """
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else default_number
+    print_table(module.COLUMNS, module.benchmark(number))
@@ -0,0 +1,63 @@
+"""
+Compare the implementations of the crop and mirror padding:
+- PIL reference: several crops, mirrors and pastes into a new image
+- PIL: a single out-of-bounds crop then the mirrors pasted in place
+- NumPy: mirror padding of an array of pixels
+- NumPy + conversion: same, including the PIL <-> NumPy copies
+- crop: `utils.crop` of the encoded image, including the decoding
+- crop_and_dump: same, including the encoding
+
+Usage: python benchmarks/crop_benchmark.py [number of runs]
+"""
+import sys
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+
+import common
+import utils
+import reference_crop
+
+# --------------------------------------------------------------------------- #
+
+DEFAULT_NUMBER = 20
+
+ASPECT_RATIOS = OrderedDict([
+    ('4:3', 4 / 3),  # crop horizontally, pad vertically
+    ('3:4', 3 / 4),  # crop vertically, pad horizontally
+])
+
+COLUMNS = ['PIL reference', 'PIL', 'NumPy', 'NumPy + conv', 'crop', 'crop_and_dump']
+
+def get_crop_functions(image, aspect_ratio):
+    W, H = image.size
+    h = int(round((W + H) / (aspect_ratio + 1)))
+    w = int(round(h * aspect_ratio))
+    if W / H < aspect_ratio:
+        return w, h, utils.crop_V_pad_H, reference_crop.pil_crop_V_pad_H
+    return w, h, utils.crop_H_pad_V, reference_crop.pil_crop_H_pad_V
+
+def benchmark(number=DEFAULT_NUMBER):
+    for resolution, size in common.RESOLUTIONS.items():
+        image = common.load_test_image(size)
+        data = utils.dump(image)
+        pixels = np.asarray(image)
+        for name, aspect_ratio in ASPECT_RATIOS.items():
+            w, h, crop_pad, pil_crop_pad = get_crop_functions(image, aspect_ratio)
+            reference = pil_crop_pad(image, w, h)[0].tobytes()
+            assert crop_pad(image, w, h)[0].tobytes() == reference
+            assert crop_pad(pixels, w, h)[0].tobytes() == reference
+
+            timings = [
+                common.time_ms(lambda: pil_crop_pad(image, w, h), number),
+                common.time_ms(lambda: crop_pad(image, w, h), number),
+                common.time_ms(lambda: crop_pad(pixels, w, h), number),
+                common.time_ms(lambda: Image.fromarray(crop_pad(np.asarray(image), w, h)[0]), number),
+                common.time_ms(lambda: utils.crop(data, aspect_ratio), number),
+                common.time_ms(lambda: utils.crop_and_dump(data, aspect_ratio), number),
+            ]
+            yield OrderedDict([('input', resolution), ('ratio', name)]), timings
+
+
+if __name__ == '__main__':
+    common.main(sys.modules[__name__], DEFAULT_NUMBER)
@@ -0,0 +1,54 @@
+"""
+Compare the drawing backends on a whole frame: decode, draw the predictions
+(directly and through a pre-rendered overlay) and encode, for a tagging result
+and detection results from 1 to 500 boxes, large or small and spread out on
+the frame.
+
+Usage: python benchmarks/draw_benchmark.py [number of runs]
+"""
+import sys
+from collections import OrderedDict
+
+import common
+import draw
+from draw_test import TEST_KWARGS
+
+# --------------------------------------------------------------------------- #
+
+DEFAULT_NUMBER = 10
+
+COLUMNS = ['decode', 'draw', 'overlay', 'encode', 'total']
+
+def get_backends():
+    backends = []
+    for name in draw.BACKENDS:
+        try:
+            draw.set_backend(name)
+            backends.append(name)
+        except Exception as e:
+            print("Skipping backend {}: {}".format(name, e), file=sys.stderr)
+    return backends
+
+def benchmark(number=DEFAULT_NUMBER):
+    backends = get_backends()
+    payloads = common.get_payloads()
+    for resolution, size in common.RESOLUTIONS.items():
+        data = common.make_test_frame(size)
+        for name in backends:
+            draw.set_backend(name)
+            image = draw.BACKEND.decode_img(data)
+            for payload_name, payload in payloads.items():
+                renderer = draw.OverlayRenderer(**TEST_KWARGS)
+                renderer.draw(image.copy(), payload)
+                timings = [
+                    common.time_ms(lambda: draw.BACKEND.decode_img(data), number),
+                    common.time_ms(lambda: draw.draw_predictions_on_image(image.copy(), payload, **TEST_KWARGS), number),
+                    common.time_ms(lambda: renderer.draw(image.copy(), payload), number),
+                    common.time_ms(lambda: draw.BACKEND.encode_img(image), number),
+                    common.time_ms(lambda: draw.draw_predictions(data, payload, **TEST_KWARGS), number),
+                ]
+                yield OrderedDict([('input', resolution), ('backend', name), ('payload', payload_name)]), timings
+
+
+if __name__ == '__main__':
+    common.main(sys.modules[__name__], DEFAULT_NUMBER)
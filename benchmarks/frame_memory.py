@@ -0,0 +1,67 @@
+"""
+Measure the peak memory allocated per frame on its way from the received NATS message
+to the serialized inference command, with the copies of the protobuf API ('copy') and
+with the frame kept as a view of the message ('view'). Allocations are traced with
+tracemalloc, which does not see those of the C++ protobuf implementation: run with
+PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python for complete figures.
+
+Usage: python benchmarks/frame_memory.py
+"""
+import gc
+import tracemalloc
+from collections import OrderedDict
+
+from deepomatic.rpc import v07_ImageInput
+from deepomatic.rpc.helpers.proto import create_serialized_command
+from deepomatic.rpc.helpers.v07_proto import create_images_input_mix, create_workflow_command_mix
+
+import common
+from nats_helper import NATSHelper
+from inference_helper import serialize_image_command
+from proto import xi_iot_pb2
+
+# --------------------------------------------------------------------------- #
+
+COLUMNS = ['copy', 'view']
+
+class Message(object):
+    def __init__(self, data):
+        self.data = data
+
+def copy_path(msg):
+    message = xi_iot_pb2.DataStreamMessage()
+    message.ParseFromString(msg.data)
+    image = message.payload
+    message.ClearField('payload')
+    inputs = create_images_input_mix([v07_ImageInput(source=b'data:image/*;binary,' + image)])
+    return create_serialized_command(inputs, create_workflow_command_mix(), forward_to=['response_queue'])
+
+def view_path(msg):
+    image, _ = NATSHelper.payload_from_message(msg)
+    return serialize_image_command(image, create_workflow_command_mix(), 'response_queue')
+
+def peak_kB(func, msg):
+    gc.collect()
+    tracemalloc.start()
+    command = func(msg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del command
+    return peak / 1000
+
+def main():
+    rows = []
+    for resolution, size in common.RESOLUTIONS.items():
+        payload = common.make_test_frame(size)
+        msg = Message(NATSHelper.message_from_payload(payload))
+        rows.append((OrderedDict([('input', resolution), ('frame kB', len(payload) // 1000)]),
+                     [peak_kB(copy_path, msg), peak_kB(view_path, msg)]))
+
+    # Same layout as the timings of the benchmarks, in kB
+    print(' '.join('{:<10}'.format(k) for k in rows[0][0]) + ''.join(' {:>14}'.format(c) for c in COLUMNS))
+    for case, peaks in rows:
+        print(' '.join('{:<10}'.format(str(v)) for v in case.values()) + ''.join(' {:>11.0f} kB'.format(p) for p in peaks))
+
+
+if __name__ == '__main__':
+    main()
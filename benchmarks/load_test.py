@@ -0,0 +1,112 @@
+"""
+Load test of the whole runtime with a stand-in neural worker and NATS broker: frames
+are published on each stream at a fixed rate and the capture-to-publish latency of
+the outputs is measured. The runtime is configured by the environment as in production.
+
+Usage:
+    python benchmarks/load_test.py [--streams 4] [--fps 25] [--duration 10] [--latency 0.05] [--jitter 0.01] [-o results.json]
+"""
+import json
+import time
+import asyncio
+import argparse
+
+import common
+from main import Config, MessageHandler
+from nats_helper import NATSHelper
+from proto import xi_iot_pb2
+from fakes import FakeWorker, InMemoryNATS
+import metrics
+
+# --------------------------------------------------------------------------- #
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+async def load(handler, nats_helper, producer, args, image):
+    topics = list(nats_helper.topics.items())
+    latencies = []
+    received = [0]
+
+    async def receive_cb(msg):
+        message = xi_iot_pb2.DataStreamMessage()
+        message.ParseFromString(msg.data)
+        latencies.append(time.time() - message.timestamp / 1e9)
+        received[0] += 1
+
+    loop = asyncio.get_event_loop()
+    await nats_helper.connect(loop, handler.message_handler)
+    await producer.connect()
+    for _, dst_topic in topics:
+        await producer.subscribe(dst_topic, cb=receive_cb)
+
+    # Publish at a fixed rate on all streams
+    n_frames = int(args.duration * args.fps)
+    start = time.monotonic()
+    for i in range(n_frames):
+        await asyncio.sleep(max(start + i / args.fps - time.monotonic(), 0))
+        for src_topic, _ in topics:
+            message = xi_iot_pb2.DataStreamMessage(timestamp=int(time.time() * 1e9), payload=image)
+            await producer.publish(src_topic, message.SerializeToString())
+    sent = n_frames * len(topics)
+
+    # Wait for the frames which were not dropped
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline and received[0] < sent - metrics.FRAMES_DROPPED.total():
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+
+    return {
+        'sent': sent,
+        'received': received[0],
+        'dropped': metrics.FRAMES_DROPPED.total(),
+        'inferred': metrics.FRAMES_INFERRED.total(),
+        'throughput_fps': received[0] / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': max(latencies) * 1000 if latencies else float('nan'),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=4, help='number of streams')
+    parser.add_argument('--fps', type=float, default=25, help='frame rate of each stream')
+    parser.add_argument('--duration', type=float, default=10, help='duration of the load in seconds')
+    parser.add_argument('--resolution', default='1080p', choices=list(common.RESOLUTIONS), help='resolution of the frames')
+    parser.add_argument('--latency', type=float, default=0.05, help='processing time of the fake worker in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='jitter of the processing time in seconds')
+    parser.add_argument('--concurrency', type=int, default=1, help='commands processed at once by the fake worker')
+    parser.add_argument('--boxes', type=int, default=5, help='number of boxes in the results')
+    parser.add_argument('--timeout', type=float, default=10, help='time to wait for the last outputs in seconds')
+    parser.add_argument('-o', '--output', help='JSON file to save the results to')
+    args = parser.parse_args()
+
+    worker = FakeWorker(latency=args.latency, jitter=args.jitter, concurrency=args.concurrency, n_boxes=args.boxes)
+    broker = InMemoryNATS()
+    topics = [('load_src_{}'.format(i), 'load_dst_{}'.format(i)) for i in range(args.streams)]
+    nats_helper = NATSHelper(nats_broker_url='nats://in-memory:4222', nats_topics=topics)
+    nats_helper.nats_client = broker.client()
+    handler = MessageHandler(Config(amqp_client=worker), nats_helper)
+    producer = broker.client()
+
+    loop = asyncio.get_event_loop()
+    try:
+        results = loop.run_until_complete(load(handler, nats_helper, producer, args, common.make_test_frame(common.RESOLUTIONS[args.resolution])))
+    finally:
+        handler.close()
+
+    results['config'] = vars(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
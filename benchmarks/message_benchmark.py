@@ -0,0 +1,36 @@
+"""
+Measure the protobuf boxing of the frames exchanged on NATS: the parsing of a
+received DataStreamMessage and the building of the published one.
+
+Usage: python benchmarks/message_benchmark.py [number of runs]
+"""
+import sys
+from collections import OrderedDict
+
+import common
+from nats_helper import NATSHelper
+
+# --------------------------------------------------------------------------- #
+
+DEFAULT_NUMBER = 200
+
+COLUMNS = ['parse', 'build']
+
+class Message(object):
+    def __init__(self, data):
+        self.data = data
+
+def benchmark(number=DEFAULT_NUMBER):
+    for resolution, size in common.RESOLUTIONS.items():
+        payload = common.make_test_frame(size)
+        msg = Message(NATSHelper.message_from_payload(payload))
+        _, source = NATSHelper.payload_from_message(msg)
+        timings = [
+            common.time_ms(lambda: NATSHelper.payload_from_message(msg), number),
+            common.time_ms(lambda: NATSHelper.message_from_payload(payload, source), number),
+        ]
+        yield OrderedDict([('input', resolution), ('kB', len(payload) // 1000)]), timings
+
+
+if __name__ == '__main__':
+    common.main(sys.modules[__name__], DEFAULT_NUMBER)
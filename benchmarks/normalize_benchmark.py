@@ -0,0 +1,41 @@
+"""
+Compare the normalization of the boxes after a crop: one ROI at a time with
+`utils.normalize_roi` or all of them at once with `utils.normalize_rois`.
+
+Usage: python benchmarks/normalize_benchmark.py [number of runs]
+"""
+import sys
+from collections import OrderedDict
+
+import common
+import utils
+
+# --------------------------------------------------------------------------- #
+
+DEFAULT_NUMBER = 100
+
+COLUMNS = ['normalize_roi', 'normalize_rois']
+
+def benchmark(number=DEFAULT_NUMBER):
+    change_of_basis_matrix = utils.get_crop_geometry(1920, 1080, 4 / 3).change_of_basis_matrix
+    for n_boxes in common.BOX_COUNTS:
+        predictions = common.make_detection_payload(n_boxes)['outputs'][0]['labels']['predicted']
+        rois = [p['roi'] for p in predictions]
+
+        # Boxes are normalized in place: work on copies so that every run gets the same input
+        def normalize_roi():
+            for roi in [{'bbox': dict(roi['bbox'])} for roi in rois]:
+                utils.normalize_roi(roi, change_of_basis_matrix)
+
+        def normalize_rois():
+            utils.normalize_rois([{'bbox': dict(roi['bbox'])} for roi in rois], change_of_basis_matrix)
+
+        timings = [
+            common.time_ms(normalize_roi, number),
+            common.time_ms(normalize_rois, number),
+        ]
+        yield OrderedDict([('boxes', n_boxes)]), timings
+
+
+if __name__ == '__main__':
+    common.main(sys.modules[__name__], DEFAULT_NUMBER)
@@ -0,0 +1,116 @@
+"""
+Run the offline benchmarks and save their results as JSON, to compare them between commits.
+
+Usage:
+    python benchmarks/run_benchmarks.py [-n NUMBER] [-o results.json] [-c baseline.json] [benchmark ...]
+
+Benchmarks are named after their module, e.g. `crop` for crop_benchmark.py, and all run by default.
+With a baseline, the timings are printed as a ratio to the baseline ones and the script
+fails if one is slower than the threshold.
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import platform
+import importlib
+import subprocess
+
+import common
+
+# --------------------------------------------------------------------------- #
+
+def get_benchmark_names():
+    paths = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*_benchmark.py'))
+    return sorted(os.path.basename(path)[:-len('_benchmark.py')] for path in paths)
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run(names, number=None):
+    results = []
+    for name in names:
+        module = importlib.import_module('{}_benchmark'.format(name))
+        print("\n# {}".format(name))
+        rows = []
+
+        def record(rows_iterator):
+            for case, timings in rows_iterator:
+                rows.append((case, timings))
+                yield case, timings
+
+        common.print_table(module.COLUMNS, record(module.benchmark(number or module.DEFAULT_NUMBER)))
+        for case, timings in rows:
+            results.append({
+                'benchmark': name,
+                'case': case,
+                'timings_ms': dict(zip(module.COLUMNS, timings)),
+            })
+    return results
+
+def get_key(result):
+    return result['benchmark'], json.dumps(result['case'], sort_keys=True)
+
+def compare(results, baseline, threshold):
+    """
+    Print the timings which changed by more than 10%, return the number of regressions above threshold
+    """
+    baseline = {get_key(r): r['timings_ms'] for r in baseline}
+    regressions = 0
+    print("\n# Comparison to baseline (new / old)")
+    for result in results:
+        old_timings = baseline.get(get_key(result))
+        if old_timings is None:
+            continue
+        for column, timing in result['timings_ms'].items():
+            old_timing = old_timings.get(column)
+            if not old_timing:
+                continue
+            ratio = timing / old_timing
+            if abs(ratio - 1) < 0.1:
+                continue
+            regression = ratio > threshold
+            regressions += regression
+            print("{:<10} {:<40} {:<14} {:>8.3f} ms -> {:>8.3f} ms  x{:.2f}{}".format(
+                result['benchmark'], ', '.join('{}'.format(v) for v in result['case'].values()), column,
+                old_timing, timing, ratio, '  REGRESSION' if regression else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, all of them by default: {}'.format(', '.join(get_benchmark_names())))
+    parser.add_argument('-n', '--number', type=int, help='number of runs per timing, each benchmark has its own default')
+    parser.add_argument('-o', '--output', help='JSON file to save the results to')
+    parser.add_argument('-c', '--compare', help='JSON file of baseline results to compare to')
+    parser.add_argument('-t', '--threshold', type=float, default=1.25, help='slowdown ratio considered a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    names = args.benchmarks or get_benchmark_names()
+    unknown = set(names) - set(get_benchmark_names())
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    results = run(names, args.number)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Compare the output formats of the inference results, for a tagging result and
+detection results from 1 to 500 boxes. The cache of the encoded results is
+bypassed so that every run encodes.
+
+Usage: python benchmarks/serialize_benchmark.py [number of runs]
+"""
+import sys
+from collections import OrderedDict
+
+import common
+from serializer import InferenceResult, ResultSerializer
+from fakes import make_proto_result
+
+# --------------------------------------------------------------------------- #
+
+DEFAULT_NUMBER = 100
+
+def get_formats():
+    formats = []
+    for output_format in ResultSerializer.FORMATS:
+        try:
+            ResultSerializer(output_format)
+            formats.append(output_format)
+        except Exception as e:
+            print("Skipping format {}: {}".format(output_format, e), file=sys.stderr)
+    return formats
+
+COLUMNS = get_formats()
+
+def benchmark(number=DEFAULT_NUMBER):
+    serializers = [ResultSerializer(output_format) for output_format in COLUMNS]
+    for payload_name, payload in common.get_payloads().items():
+        result = InferenceResult(payload['outputs'], make_proto_result(payload))
+
+        def serialize(serializer):
+            result.payloads.clear()
+            return serializer.serialize(result)
+
+        timings = [common.time_ms(lambda: serialize(serializer), number) for serializer in serializers]
+        yield OrderedDict([('payload', payload_name)]), timings
+
+
+if __name__ == '__main__':
+    common.main(sys.modules[__name__], DEFAULT_NUMBER)
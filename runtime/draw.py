@@ -1,11 +1,14 @@
 import os
-import io
 import textwrap
 import logging
+import threading
 from colorsys import rgb_to_hls, hls_to_rgb
 
+import numpy as np
 from PIL import Image, ImageFont, ImageDraw
 
+import utils
+
 logger = logging.getLogger(__name__)
 
 # --------------------------------------------------------------------------- #
@@ -64,6 +67,7 @@ FONT_SIZE_RATIO = 1.
 FONT_SCALE_PCT = get_font_size()
 FONT_SIZE = None
 FONT = None
+FONT_LOCK = threading.Lock()  # Frames are drawn from a thread pool, the font is set by the first one
 FONT_COLOR = get_color('FONT_COLOR', (255, 255, 255))
 BOX_COLOR = get_color('BOX_COLOR', (34, 165, 247))
 BACKGROUND_COLOR = darken_color(*BOX_COLOR, factor=0.4)
@@ -71,66 +75,181 @@ BACKGROUND_COLOR = set_opacity(*BACKGROUND_COLOR, opacity=0.8)
 
 # --------------------------------------------------------------------------- #
 
-if False:  # use cv2
-    import cv2
-    import numpy as np
+class PILBackend(object):
+    """
+    Draws on RGB PIL images
+    """
 
-    def set_font(ratio):
-        global FONT, FONT_SIZE_RATIO, FONT_SIZE
-        FONT_SIZE_RATIO = ratio * FONT_SCALE_PCT / 100
-        FONT_SIZE = int(5 * FONT_SIZE_RATIO)
-        FONT = cv2.FONT_HERSHEY_SIMPLEX
-
-    def get_text_size(text):
-        thickness = max(1, int(FONT_SIZE) * 2)
-        ret, baseline_to_bottom = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, FONT_SIZE, thickness)
-        return (ret[0], ret[1] + baseline_to_bottom), baseline_to_bottom
-
-    def draw_text(image, text, corner):
-        thickness = max(1, int(FONT_SIZE) * 2)
-        cv2.putText(image, text, corner, FONT, FONT_SIZE, FONT_COLOR, thickness)
-
-    def draw_box(image, corner1, corner2, color, tickness=1):
-        cv2.rectangle(image, corner1, corner2, color, tickness)
-
-    def load_img(image):
-        image = cv2.imdecode(np.asarray(bytearray(image), dtype=np.uint8), 1)
-        output_image = image.copy()
-        height = output_image.shape[0]
-        width = output_image.shape[1]
-        return image, output_image, width, height
-
-    def save_img(image, output_image):
-        retval, buf = cv2.imencode('.jpeg', output_image)
-        return buf
-
-else:  # use PIL
-    def set_font(ratio):
+    name = 'pil'
+    OVERLAY_AREA_PER_PREDICTION = 400000  # Pixels of overlay blended in the time a prediction is drawn
+
+    def set_font(self, ratio):
         global FONT, FONT_SIZE_RATIO, FONT_SIZE
         FONT_SIZE_RATIO = ratio * FONT_SCALE_PCT / 100
         FONT_SIZE = int(48 * FONT_SIZE_RATIO)
         FONT = ImageFont.truetype(os.path.join(os.path.dirname(__file__), "assets", "fonts", "arial.ttf"), FONT_SIZE)
 
-    def get_text_size(text):
+    def get_text_size(self, text):
         (width, height) = FONT.getsize(text)
         return (width, height), -3
 
-    def draw_text(image, text, corner):
+    def draw_text(self, image, text, corner):
         image.text(corner, text, FONT_COLOR, font=FONT)
 
-    def draw_box(image, corner1, corner2, color, tickness=3):
+    def draw_box(self, image, corner1, corner2, color, tickness=3):
         image.rectangle([corner1, corner2], color if tickness < 0 else None, outline=color, width=tickness)
 
-    def load_img(image):
-        img = Image.open(io.BytesIO(image))
-        draw = ImageDraw.Draw(img, mode='RGBA')
-        width, height = img.size
-        return img, draw, width, height
+    def decode_img(self, image):
+        return utils.load(image)
+
+    def encode_img(self, image):
+        return utils.dump(image)
+
+    def load_img(self, image):
+        draw = ImageDraw.Draw(image, mode='RGBA')
+        width, height = image.size
+        return image, draw, width, height
+
+    def new_layer(self, size):
+        return Image.new('RGBA', size, (0, 0, 0, 0))
+
+    def get_alpha(self, layer):
+        return np.asarray(layer.getchannel('A'))
+
+    def crop_layer(self, layer, box):
+        return layer.crop(box)
+
+    def blend(self, image, patch, corner):
+        image.paste(patch, corner, patch)
+
+
+class CV2Backend(object):
+    """
+    Draws on BGR images decoded by OpenCV, transparent layers are BGRA
+    """
+
+    name = 'cv2'
+    OVERLAY_AREA_PER_PREDICTION = 60000  # Pixels of overlay blended in the time a prediction is drawn
+    CAP_HEIGHT = 0.88  # Height of capital letters relative to the PIL font size, for texts of the same width
+
+    def __init__(self):
+        try:
+            import cv2
+        except ImportError:
+            raise Exception('OpenCV must be installed for the {} drawing backend'.format(self.name))
+        self._cv2 = cv2
+
+    @staticmethod
+    def _color(image, color):
+        # RGB(A) to BGR(A) matching the number of channels of the image
+        bgr = (color[2], color[1], color[0])
+        if image.shape[2] == 4:
+            return bgr + (color[3] if len(color) == 4 else 255,)
+        return bgr
+
+    def _thickness(self):
+        return max(1, int(round(FONT_SIZE)))
+
+    def set_font(self, ratio):
+        global FONT, FONT_SIZE_RATIO, FONT_SIZE
+        FONT_SIZE_RATIO = ratio * FONT_SCALE_PCT / 100
+        font = self._cv2.FONT_HERSHEY_SIMPLEX
+        # Scale the font so that texts take as much room as with the PIL backend
+        (_, cap_height), _ = self._cv2.getTextSize('H', font, 1, 1)
+        FONT_SIZE = 48 * FONT_SIZE_RATIO * self.CAP_HEIGHT / cap_height
+        # FONT is assigned last as the other draws only wait for it
+        FONT = font
+
+    def get_text_size(self, text):
+        (width, height), baseline = self._cv2.getTextSize(text, FONT, FONT_SIZE, self._thickness())
+        return (width, height + baseline), 0
+
+    def draw_text(self, image, text, corner):
+        # OpenCV draws from the bottom left corner of the text
+        thickness = self._thickness()
+        (width, height), baseline = self._cv2.getTextSize(text, FONT, FONT_SIZE, thickness)
+        corner = (int(corner[0]), int(corner[1] + height))
+        if image.shape[2] == 3:
+            self._cv2.putText(image, text, corner, FONT, FONT_SIZE, self._color(image, FONT_COLOR), thickness, self._cv2.LINE_AA)
+            return
+
+        # On a transparent layer, anti-aliasing would blend the alpha channel too and make the
+        # text see-through: draw its coverage on a mask and composite it over the layer instead
+        xmin, ymin = max(corner[0] - thickness, 0), max(corner[1] - height - thickness, 0)
+        xmax = min(corner[0] + width + thickness, image.shape[1])
+        ymax = min(corner[1] + baseline + thickness, image.shape[0])
+        if xmin >= xmax or ymin >= ymax:
+            return
+        roi = image[ymin:ymax, xmin:xmax]
+        mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+        self._cv2.putText(mask, text, (corner[0] - xmin, corner[1] - ymin), FONT, FONT_SIZE, 255, thickness, self._cv2.LINE_AA)
+
+        coverage = mask[:, :, None] / 255.
+        alpha = roi[:, :, 3:] / 255. * (1 - coverage)
+        out_alpha = coverage + alpha
+        colors = np.array(self._color(image, FONT_COLOR)[:3]) * coverage + roi[:, :, :3] * alpha
+        roi[:, :, :3] = np.round(colors / np.maximum(out_alpha, 1e-6))
+        roi[:, :, 3:] = np.round(out_alpha * 255)
+
+    def draw_box(self, image, corner1, corner2, color, tickness=3):
+        corner1 = (int(corner1[0]), int(corner1[1]))
+        corner2 = (int(corner2[0]), int(corner2[1]))
+        if tickness < 0 and len(color) == 4 and image.shape[2] == 3:
+            # OpenCV ignores the opacity: blend the filled box
+            xmin, ymin = max(corner1[0], 0), max(corner1[1], 0)
+            roi = image[ymin:corner2[1] + 1, xmin:corner2[0] + 1]
+            alpha = color[3] / 255.
+            roi[:] = roi * (1 - alpha) + np.array(self._color(image, color), dtype=np.float32) * alpha
+        else:
+            self._cv2.rectangle(image, corner1, corner2, self._color(image, color), tickness)
+
+    def decode_img(self, image):
+        return self._cv2.imdecode(np.frombuffer(image, dtype=np.uint8), self._cv2.IMREAD_COLOR)
+
+    def encode_img(self, image):
+        retval, buf = self._cv2.imencode('.jpeg', image)
+        return buf.tobytes()
+
+    def load_img(self, image):
+        height = image.shape[0]
+        width = image.shape[1]
+        return image, image, width, height
 
-    def save_img(image, draw):
-        with io.BytesIO() as buff:
-            image.save(buff, format="JPEG")
-            return buff.getvalue()
+    def new_layer(self, size):
+        return np.zeros((size[1], size[0], 4), dtype=np.uint8)
+
+    def get_alpha(self, layer):
+        return layer[:, :, 3]
+
+    def crop_layer(self, layer, box):
+        xmin, ymin, xmax, ymax = box
+        layer = layer[ymin:ymax, xmin:xmax]
+        # Premultiply colors so that blending is one multiplication and one addition
+        alpha = np.repeat(layer[:, :, 3:], 3, axis=2)
+        colors = self._cv2.multiply(layer[:, :, :3], alpha, scale=1 / 255.)
+        return colors, 255 - alpha
+
+    def blend(self, image, patch, corner):
+        colors, inverse_alpha = patch
+        x, y = corner
+        roi = image[y:y + colors.shape[0], x:x + colors.shape[1]]
+        roi[:] = self._cv2.add(self._cv2.multiply(roi, inverse_alpha, scale=1 / 255.), colors)
+
+
+BACKENDS = {backend.name: backend for backend in [PILBackend, CV2Backend]}
+BACKEND = None
+
+def set_backend(name):
+    """
+    Select the drawing backend, `pil` or `cv2`
+    """
+    global BACKEND, FONT
+    if name not in BACKENDS:
+        raise Exception('Unknown drawing backend {n}, should be one of: {l}'.format(n=name, l=', '.join(BACKENDS)))
+    BACKEND = BACKENDS[name]()
+    FONT = None
+
+set_backend(os.getenv('DRAW_BACKEND', PILBackend.name))
 
 # --------------------------------------------------------------------------- #
 
@@ -145,8 +264,17 @@ def get_coordinates_from_roi(roi, width, height):
     ymax = int(bbox['ymax'] * height)
     return (xmin, ymin, xmax, ymax)
 
-def draw_predictions(image, inference_result, draw_labels=True, draw_scores=False, draw_only_first_tag=True, hcentrate=False, valign=-1):
-    img, output_image, width, height = load_img(image)
+def draw_predictions(image, inference_result, **kwargs):
+    """
+    Draw the predictions on an encoded image and return the encoded result
+    """
+    return BACKEND.encode_img(draw_predictions_on_image(BACKEND.decode_img(image), inference_result, **kwargs))
+
+def draw_predictions_on_image(image, inference_result, draw_labels=True, draw_scores=False, draw_only_first_tag=True, hcentrate=False, valign=-1):
+    """
+    Draw the predictions in place on a decoded image and return it
+    """
+    img, output_image, width, height = BACKEND.load_img(image)
     tag_drawn = 0
     is_classification = None
     for pred in inference_result['outputs'][0]['labels']['predicted']:
@@ -164,10 +292,12 @@ def draw_predictions(image, inference_result, draw_labels=True, draw_scores=Fals
         roi = pred.get('roi')
         is_classification = roi is None
         if FONT is None:
-            set_font(1 if is_classification else 0.6)
+            with FONT_LOCK:
+                if FONT is None:
+                    BACKEND.set_font(1 if is_classification else 0.6)
 
         # Get text draw parameters
-        text_size, baseline_offset = get_text_size(label)
+        text_size, baseline_offset = BACKEND.get_text_size(label)
         text_offset = (0, baseline_offset)
         text_margin_height = max(1, 0.1 * text_size[1])
         text_margin_width = text_margin_height + 4
@@ -195,7 +325,7 @@ def draw_predictions(image, inference_result, draw_labels=True, draw_scores=Fals
             xmin, ymin, xmax, ymax = get_coordinates_from_roi(roi, width, height)
 
             # Draw bounding box
-            draw_box(output_image, (xmin, ymin), (xmax, ymax), BOX_COLOR, tickness=BOX_THICKNESS)
+            BACKEND.draw_box(output_image, (xmin, ymin), (xmax, ymax), BOX_COLOR, tickness=BOX_THICKNESS)
 
             # Get text top left corner
             if hcentrate:
@@ -218,10 +348,86 @@ def draw_predictions(image, inference_result, draw_labels=True, draw_scores=Fals
         text_corner = add_tuple(add_tuple(text_corner, offset), text_margin)
 
         # Finally draw everything
-        draw_box(output_image, text_top_left, text_bottom_right, BACKGROUND_COLOR, -1)
-        draw_text(output_image, label, text_corner)
+        BACKEND.draw_box(output_image, text_top_left, text_bottom_right, BACKGROUND_COLOR, -1)
+        BACKEND.draw_text(output_image, label, text_corner)
         tag_drawn += 1
         if is_classification and draw_only_first_tag:  # if is_detection is None we should continue
             break
 
-    return save_img(img, output_image)
+    return img
+
+# --------------------------------------------------------------------------- #
+
+def get_patches(alpha, tile_size):
+    """
+    Return the boxes covering the non-transparent pixels of a layer: the tiles of `tile_size`
+    with such pixels, merged along each row of tiles. Boxes of predictions spread out on the
+    frame then only cover their outlines and labels rather than the whole frame.
+    """
+    height, width = alpha.shape
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    padded = np.zeros((rows * tile_size, cols * tile_size), dtype=bool)
+    padded[:height, :width] = alpha > 0
+    tiles = padded.reshape((rows, tile_size, cols, tile_size)).any(axis=(1, 3))
+
+    boxes = []
+    for row in np.flatnonzero(tiles.any(axis=1)):
+        # Runs of consecutive tiles of the row
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], tiles[row].astype(np.int8), [0]))))
+        ymin, ymax = row * tile_size, min((row + 1) * tile_size, height)
+        for start, end in zip(edges[::2], edges[1::2]):
+            boxes.append((int(start * tile_size), int(ymin), int(min(end * tile_size, width)), int(ymax)))
+    return boxes
+
+class Overlay(object):
+    """
+    Predictions rendered on a transparent layer, kept as patches of its non-transparent area.
+    When blending the patches costs more than drawing the predictions again, for a few large
+    boxes, the overlay draws them directly instead.
+    """
+
+    def __init__(self, patches, inference_result=None, kwargs=None):
+        self.patches = patches  # (prepared patch, top left corner), None to draw directly
+        self.inference_result = inference_result
+        self.kwargs = kwargs
+
+    def apply(self, image):
+        """
+        Blend the overlay in place on an image of the size it was rendered for
+        """
+        if self.patches is None:
+            return draw_predictions_on_image(image, self.inference_result, **self.kwargs)
+        for patch, corner in self.patches:
+            BACKEND.blend(image, patch, corner)
+        return image
+
+OVERLAY_TILE_SIZE = 32
+
+def render_overlay(inference_result, size, **kwargs):
+    layer = BACKEND.new_layer(size)
+    draw_predictions_on_image(layer, inference_result, **kwargs)
+    boxes = get_patches(BACKEND.get_alpha(layer), OVERLAY_TILE_SIZE)
+    area = sum((xmax - xmin) * (ymax - ymin) for xmin, ymin, xmax, ymax in boxes)
+    n_predictions = len(inference_result['outputs'][0]['labels']['predicted']) + 1
+    if area > n_predictions * BACKEND.OVERLAY_AREA_PER_PREDICTION:
+        return Overlay(None, inference_result, kwargs)
+    return Overlay([(BACKEND.crop_layer(layer, box), box[:2]) for box in boxes])
+
+class OverlayRenderer(object):
+    """
+    Draws predictions by rendering them once per inference result and image size,
+    the frames sharing an inference result then only cost one blend of the overlay
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        # Swapped as a whole so that threads drawing concurrently never mix two renderings
+        self._cache = (None, None, None)  # inference result, size, overlay
+
+    def draw(self, image, inference_result):
+        size = utils.get_size(image)
+        cached_result, cached_size, overlay = self._cache
+        if inference_result is not cached_result or size != cached_size:
+            overlay = render_overlay(inference_result, size, **self._kwargs)
+            self._cache = (inference_result, size, overlay)
+        return overlay.apply(image)
@@ -0,0 +1,130 @@
+import io
+from PIL import Image
+
+import utils
+
+# --------------------------------------------------------------------------- #
+
+class Frame(object):
+    """
+    An image flowing through the pipeline: it is decoded at most once, when its pixels
+    are first needed, and encoded only when its bytes are needed after a modification.
+    The codec may be given to decode to another representation than PIL images,
+    e.g. the arrays of the OpenCV drawing backend.
+    """
+
+    def __init__(self, data, decode=utils.load, encode=utils.dump):
+        self._data = data    # Encoded image, None once the pixels have been modified
+        self._image = None   # Decoded image
+        self._decode = decode
+        self._encode = encode
+
+        self.source = None   # Message the frame was received in, without its payload
+        self.trace = None    # Spans of the stages of the frame if it is traced
+        self.deadline = None  # Time, on the monotonic clock, at which the frame must be published
+        self._thumbnails = {}  # size -> grayscale thumbnail
+
+    @classmethod
+    def from_image(cls, image, decode=utils.load, encode=utils.dump):
+        frame = cls(None, decode, encode)
+        frame._image = image
+        return frame
+
+    def _derive(self, image):
+        # PIL images are always RGB, arrays keep the channel order of this frame
+        if isinstance(image, Image.Image):
+            return Frame.from_image(image)
+        return Frame.from_image(image, self._decode, self._encode)
+
+    @property
+    def decoded(self):
+        return self._image is not None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = self._decode(self._data)
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        # Pixels changed: the encoded image and the thumbnails are not valid anymore
+        self._image = image
+        self._data = None
+        self._thumbnails = {}
+
+    @property
+    def size(self):
+        return utils.get_size(self.image)
+
+    def thumbnail(self, size):
+        """
+        Return a grayscale thumbnail of the frame as an array, computed once per size.
+        It is computed from the pixels if decoded, otherwise from a reduced scale decoding.
+        """
+        thumbnail = self._thumbnails.get(size)
+        if thumbnail is None:
+            image = self._image if self._image is not None else self._data
+            thumbnail = self._thumbnails[size] = utils.get_thumbnail(image, size)
+        return thumbnail
+
+    def resized(self, max_size, draft=False):
+        """
+        Return the frame downscaled so that its largest side is at most `max_size`.
+        With `draft`, a frame which is not decoded yet is decoded directly at a reduced
+        scale by the JPEG decoder: use it when the full resolution will not be needed.
+        """
+        if self._image is None and draft:
+            image = Image.open(io.BytesIO(self._data))
+        else:
+            image = self.image
+
+        size = utils.get_downscaled_size(utils.get_size(image), max_size)
+        if size == utils.get_size(image):
+            return self
+        if image is not self._image:
+            image.draft('RGB', size)
+        return self._derive(utils.resize(image, size))
+
+    def cropped(self, aspect_ratio):
+        """
+        Return the frame cropped to `aspect_ratio` and the change of basis matrix of the crop
+        """
+        image, change_of_basis_matrix = utils.crop(self.image, aspect_ratio)
+        return self._derive(image), change_of_basis_matrix
+
+    def copy(self):
+        """
+        Return a frame with a copy of the pixels, to modify while this frame may still be read
+        """
+        return self._derive(self.image.copy())
+
+    def to_bytes(self):
+        if self._data is None:
+            self._data = self._encode(self._image)
+        return self._data
+
+# --------------------------------------------------------------------------- #
+
+def prepare_inference_image(frame, max_size=None, aspect_ratio=None, draft=False):
+    """
+    Downscale and crop a frame for inference, return its encoded image and the change
+    of basis matrix of the crop (None if not cropped).
+    The received bytes are returned as is unless the image is downscaled or cropped.
+    """
+    # Normalized coordinates do not depend on the scale so the change of basis is not affected
+    if max_size is not None:
+        frame = frame.resized(max_size, draft=draft)
+
+    if aspect_ratio is not None:
+        frame, change_of_basis_matrix = frame.cropped(aspect_ratio)
+    else:
+        change_of_basis_matrix = None
+    return frame.to_bytes(), change_of_basis_matrix
+
+def prepare_inference_data(data, max_size=None, aspect_ratio=None):
+    """
+    Same as `prepare_inference_image` from encoded bytes, to be run in another process:
+    the decoded image is not kept so it is always decoded at a reduced scale.
+    """
+    return prepare_inference_image(Frame(data), max_size, aspect_ratio, draft=True)
@@ -0,0 +1,311 @@
+import time
+import logging
+import asyncio
+import queue
+import threading
+
+from deepomatic.rpc.helpers.proto import BINARY_IMAGE_PREFIX, create_command_info
+from deepomatic.rpc.buffers.protobuf.nn.Command_pb2 import Command
+from deepomatic.rpc.buffers.protobuf.nn.Message_pb2 import Message
+
+import wire
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------- #
+
+def get_field_path(descriptor, names):
+    numbers = []
+    for name in names:
+        field = descriptor.fields_by_name[name]
+        numbers.append(field.number)
+        descriptor = field.message_type
+    return numbers
+
+# Fields from a command message to the source of its first v0.7 image input
+IMAGE_SOURCE_PATH = get_field_path(Message.DESCRIPTOR, ['command', 'input_mix', 'v07_inputs', 'inputs', 'image', 'source'])
+
+def serialize_image_command(image, command_mix, reply_to=None):
+    """
+    Serialize the inference command of a mono-input network on an encoded image, as
+    `Client.command` does with `create_images_input_mix`, but with a single copy of the
+    image, straight into the buffer. Serialized messages being merged when concatenated,
+    the image input is appended to the serialized command without it, from the image
+    and the headers of the fields it is nested in.
+    """
+    base_info = create_command_info(forward_to=None if reply_to is None else [reply_to])
+    head = Message(command=Command(command_mix=command_mix, base_info=base_info)).SerializeToString()
+
+    headers = []
+    length = len(BINARY_IMAGE_PREFIX) + len(image)
+    for number in reversed(IMAGE_SOURCE_PATH):
+        headers.insert(0, wire.encode_field_header(number, length))
+        length += len(headers[0])
+    return b''.join([head] + headers + [BINARY_IMAGE_PREFIX, image])
+
+# --------------------------------------------------------------------------- #
+
+class WorkerQueue(object):
+    """
+    The command queue of a neural worker, with its outstanding commands and observed latency.
+    It has room for `max_in_flight` outstanding commands, a single one until a first response
+    tells that the worker is alive. A worker which did not respond is out of rotation for
+    `retry_delay` seconds, doubled at each consecutive failure up to `max_retry_delay`.
+    """
+
+    SMOOTHING = 0.2  # Weight of a new measure in the moving average of the latency
+
+    def __init__(self, name, max_in_flight=1, retry_delay=5., max_retry_delay=60.):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.outstanding = 0
+        self.latency = None  # Moving average of the round-trip time, None until a first response
+        self.failures = 0    # Consecutive commands without a response
+        self.disabled_until = 0.
+
+        metrics.WORKER_OUTSTANDING.labels(name).set_function(lambda: self.outstanding)
+
+    def available(self, now):
+        return now >= self.disabled_until
+
+    def has_room(self):
+        if self.latency is None:
+            return self.outstanding == 0
+        return self.outstanding < self.max_in_flight
+
+    def expected_latency(self, default_latency=0.):
+        """
+        Expected time for a new command to be answered if the worker processes its commands one after the other,
+        from `default_latency` if the worker was not measured yet
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        return (self.outstanding + 1) * latency
+
+    def record_response(self, latency):
+        self.latency = latency if self.latency is None else self.latency + self.SMOOTHING * (latency - self.latency)
+        self.failures = 0
+
+    def record_failure(self, now):
+        self.failures += 1
+        delay = min(self.retry_delay * 2 ** (self.failures - 1), self.max_retry_delay)
+        self.disabled_until = now + delay
+        logger.warning("Worker queue '{}' taken out of rotation for {:.1f}s".format(self.name, delay))
+
+# --------------------------------------------------------------------------- #
+
+class InferenceHelper(object):
+    """
+    Sends inference commands to the neural workers without blocking the event loop.
+    At most `max_in_flight` commands per worker are waiting for a response at any time,
+    each one being resolved by a future when its response is received.
+
+    Each command goes to the worker queue with room expected to answer it first, from its
+    outstanding commands and observed latency, the mean one of the other workers if it was
+    not measured yet. A command without a response after `timeout` seconds fails and its
+    worker is taken out of rotation for a while. If all workers are out of rotation, the
+    one coming back first is used.
+
+    Commands are not micro-batched: a v0.7 command holds the inputs of a single call of
+    the network, a mono-input one here, so several frames cannot share a command. Holding
+    commands back to send them in bursts would only delay each frame, the worker already
+    being kept busy by the commands in flight.
+
+    A command whose frame was published without it, past its deadline, still holds its
+    room in its worker queue: its response is the latest result for the frames which follow.
+
+    The AMQP connection is used by a thread only, as it is not thread safe: it publishes
+    the commands and drains the connection while some are outstanding, handing the
+    responses to the event loop. Without outstanding commands, it waits for one to send
+    `idle_timeout` seconds at most before checking whether the helper was closed.
+    """
+
+    def __init__(self, amqp_client, command_queue_names, amqp_response_queue, amqp_consumer,
+                 max_in_flight=1, timeout=None, retry_delay=5.,
+                 idle_timeout=0.05, drain_events_timeout=0.001):
+        if isinstance(command_queue_names, str):
+            command_queue_names = [command_queue_names]
+        if not command_queue_names:
+            raise Exception('No worker command queue provided')
+        self._amqp_client = amqp_client
+        self.workers = [WorkerQueue(name, max_in_flight, retry_delay) for name in command_queue_names]
+        self._amqp_response_queue = amqp_response_queue
+        self._amqp_consumer = amqp_consumer
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._drain_events_timeout = drain_events_timeout
+
+        self._outgoing = queue.Queue()  # (command, worker queue, future) to be published by the AMQP thread
+        self._pending = {}  # correlation_id -> (future, worker queue, time sent, timeout handle)
+        self._waiters = []  # futures of the commands waiting for a worker queue with room
+        self._amqp_thread = None
+        self._closed = threading.Event()
+
+    @property
+    def in_flight(self):
+        return sum(w.outstanding for w in self.workers)
+
+    def choose_worker(self, now):
+        """
+        Return the worker queue to send a command to, None if it has no room
+        """
+        workers = [w for w in self.workers if w.available(now)]
+        if not workers:
+            worker = min(self.workers, key=lambda w: w.disabled_until)
+            return worker if worker.has_room() else None
+
+        workers = [w for w in workers if w.has_room()]
+        if not workers:
+            return None
+        measured = [w.latency for w in self.workers if w.latency is not None]
+        default_latency = sum(measured) / len(measured) if measured else 0.
+        return min(workers, key=lambda w: (w.expected_latency(default_latency), w.outstanding))
+
+    async def wait_worker(self, deadline=None):
+        """
+        Return the worker queue to send a command to once it has room for it.
+        Raise asyncio.TimeoutError if it has none before `deadline`.
+        """
+        while True:
+            worker = self.choose_worker(time.monotonic())
+            if worker is not None:
+                return worker
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(deadline - time.monotonic(), 0))
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    async def send(self, command, deadline=None):
+        """
+        Send a serialized command as soon as a worker queue has room for it and return
+        a future of its response. Raise asyncio.TimeoutError if none has before `deadline`.
+        """
+        worker = await self.wait_worker(deadline)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        worker.outstanding += 1
+        self._outgoing.put((command, worker, future))
+        if self._amqp_thread is None or not self._amqp_thread.is_alive():
+            self._amqp_thread = threading.Thread(target=self._run_amqp, args=(loop,), daemon=True)
+            self._amqp_thread.start()
+        return future
+
+    def _release(self, worker):
+        worker.outstanding -= 1
+
+        # Its worker queue has room again: the waiting commands check which one to go to
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _pop(self, correlation_id):
+        future, worker, sent_at, timeout_handle = self._pending.pop(correlation_id)
+        if timeout_handle is not None:
+            timeout_handle.cancel()
+        self._release(worker)
+        return future, worker, sent_at
+
+    # Called on the event loop by the AMQP thread
+
+    def _sent(self, correlation_id, future, worker, sent_at):
+        timeout_handle = None
+        if self._timeout is not None:
+            delay = sent_at + self._timeout - time.monotonic()
+            timeout_handle = asyncio.get_event_loop().call_later(delay, self._expire, correlation_id)
+        self._pending[correlation_id] = (future, worker, sent_at, timeout_handle)
+
+    def _send_failed(self, future, worker, error):
+        self._release(worker)
+        if not future.done():
+            future.set_exception(error)
+
+    def _dispatch(self, response, received_at):
+        correlation_id = response.msg.properties.get('correlation_id')
+        if correlation_id not in self._pending:
+            logger.warning("Dropping response with unknown or expired correlation_id '{}'".format(correlation_id))
+            return
+        future, worker, sent_at = self._pop(correlation_id)
+        worker.record_response(received_at - sent_at)
+        if not future.done():
+            future.set_result(response)
+
+    def _fail_pending(self, error):
+        # Fail all pending commands as their responses will never be dispatched
+        logger.error("{}".format(error))
+        for correlation_id in list(self._pending):
+            future, _, _ = self._pop(correlation_id)
+            if not future.done():
+                future.set_exception(error)
+
+    def _expire(self, correlation_id):
+        """
+        Fail a command pending for longer than the timeout and take its worker out of rotation
+        """
+        if correlation_id not in self._pending:
+            return
+        future, worker, _ = self._pop(correlation_id)
+        now = time.monotonic()
+        if worker.available(now):
+            worker.record_failure(now)
+        if not future.done():
+            future.set_exception(Exception("No response from worker queue '{}' after {}s".format(worker.name, self._timeout)))
+
+    # AMQP thread
+
+    def _run_amqp(self, loop):
+        """
+        Publish the commands and hand the responses to the event loop until the helper is closed
+        """
+        while not self._closed.is_set():
+            # Wait for a command while none is outstanding, otherwise only publish those already queued
+            block = self.in_flight == 0
+            try:
+                while True:
+                    command, worker, future = self._outgoing.get(block, self._idle_timeout)
+                    block = False
+                    try:
+                        correlation_id = self._amqp_client.send_binary(
+                            command, worker.name,
+                            reply_to=self._amqp_response_queue.name)
+                    except Exception as e:
+                        loop.call_soon_threadsafe(self._send_failed, future, worker, e)
+                        continue
+                    loop.call_soon_threadsafe(self._sent, correlation_id, future, worker, time.monotonic())
+            except queue.Empty:
+                pass
+            if self.in_flight == 0:
+                continue
+
+            try:
+                # `timeout=None` only drains the connection once, for `drain_events_timeout` seconds at most
+                response = self._amqp_consumer.get(timeout=None, drain_events_timeout=self._drain_events_timeout)
+            except Exception as e:
+                # The next command sent starts a new thread
+                loop.call_soon_threadsafe(self._fail_pending, e)
+                return
+            if response is not None:
+                loop.call_soon_threadsafe(self._dispatch, response, time.monotonic())
+
+    def close(self):
+        self._closed.set()
+        if self._amqp_thread is not None:
+            self._amqp_thread.join()
+            self._amqp_thread = None
+        while not self._outgoing.empty():
+            _, worker, future = self._outgoing.get()
+            worker.outstanding -= 1
+            future.cancel()
+        for correlation_id in list(self._pending):
+            future, _, _ = self._pop(correlation_id)
+            future.cancel()
@@ -1,32 +1,71 @@
-import json
 import os
+import time
 import asyncio
 import logging
 from google.protobuf.json_format import MessageToDict
 
 from deepomatic.rpc.client import Client
-from deepomatic.rpc import v07_ImageInput
-from deepomatic.rpc.helpers.v07_proto import create_images_input_mix, create_workflow_command_mix
+from deepomatic.rpc.response import parse_result_buffer
+from deepomatic.rpc.helpers.v07_proto import create_workflow_command_mix
 
 from nats_helper import NATSHelper
-from draw import draw_predictions
+from inference_helper import InferenceHelper, serialize_image_command
+from sampler import FixedFrameSampler, AdaptiveFrameSampler, MotionGate
+import draw
+from frame import Frame, prepare_inference_image, prepare_inference_data
+from pool import WorkerPool
+from result_cache import ResultCache
+from tracker import Tracks
+import metrics
+import tracing
+from serializer import InferenceResult, ResultSerializer
 import utils
 
 logger = logging.getLogger(__name__)
 
+PREPROCESS = tracing.Stage('preprocess')
+INFERENCE = tracing.Stage('inference')
+CONVERT = tracing.Stage('convert')
+TRACK = tracing.Stage('track')
+DRAW = tracing.Stage('draw')
+SERIALIZE = tracing.Stage('serialize')
+PUBLISH = tracing.Stage('publish')
+
 # --------------------------------------------------------------------------- #
 
 class Config(object):
     """
-    Stores global configuration
+    Stores global configuration. The RPC client of the neural worker is created from
+    AMQP_URL unless an `amqp_client` is given, e.g. a stand-in for load tests.
     """
 
-    def __init__(self):
+    def __init__(self, amqp_client=None):
         # Should we draw a label or just pass inference results ?
         self.draw_demo = os.getenv('DRAW_DEMO') == "1"
 
-        # Configure frames to process
+        # Format of the inference results when they are not drawn: json, protobuf or msgpack
+        self.output_format = os.getenv('OUTPUT_FORMAT', ResultSerializer.JSON)
+
+        # Configure frames to process: adaptive if a target inference rate is given, fixed otherwise
         self.process_each_n_frames = int(os.getenv('PROCESS_EACH_N_FRAMES', '1'))
+        self.target_inference_fps = os.getenv('TARGET_INFERENCE_FPS')
+        if self.target_inference_fps is not None:
+            self.target_inference_fps = float(self.target_inference_fps)
+        self.latency_budget = float(os.getenv('LATENCY_BUDGET_MS', '1000')) / 1000
+        self.min_process_each_n_frames = int(os.getenv('MIN_PROCESS_EACH_N_FRAMES', '1'))
+        self.max_process_each_n_frames = int(os.getenv('MAX_PROCESS_EACH_N_FRAMES', '300'))
+
+        # Configure the gating of the frames to process by the change of the scene, disabled if no
+        # threshold is given: mean absolute difference of the gray levels and maximum time between inferences
+        self.motion_threshold = os.getenv('MOTION_THRESHOLD')
+        if self.motion_threshold is not None:
+            self.motion_threshold = float(self.motion_threshold)
+        self.motion_max_staleness = float(os.getenv('MOTION_MAX_STALENESS_MS', '5000')) / 1000
+
+        # Configure downscaling of the images sent to inference (may be none)
+        self.inference_max_size = os.getenv('INFERENCE_MAX_SIZE')
+        if self.inference_max_size is not None:
+            self.inference_max_size = int(self.inference_max_size)
 
         # Configure aspect ratio resizing (may be none)
         self.crop_aspect_ratio = os.getenv('CROP_ASPECT_RATIO')
@@ -34,88 +73,431 @@ class Config(object):
             self.crop_aspect_ratio = float(self.crop_aspect_ratio)
 
         # Setup deepomatic Run RPC client
-        amqp_url = os.getenv('AMQP_URL')
-        if amqp_url is None:
-            raise Exception('AMQP broker not provided in environment var AMQP_URL')
-        self.command_queue_name = os.getenv('WORKER_QUEUE', 'default')
-        self.amqp_client = Client(amqp_url)
-        self.amqp_client.new_queue(self.command_queue_name)
+        if amqp_client is None:
+            amqp_url = os.getenv('AMQP_URL')
+            if amqp_url is None:
+                raise Exception('AMQP broker not provided in environment var AMQP_URL')
+            amqp_client = Client(amqp_url)
+        # Command queues of the neural workers, comma separated, the commands being routed to the least busy one
+        self.command_queue_names = [q.strip() for q in os.getenv('WORKER_QUEUE', 'default').split(',') if q.strip()]
+        self.amqp_client = amqp_client
+        for command_queue_name in self.command_queue_names:
+            self.amqp_client.new_queue(command_queue_name)
         self.amqp_response_queue, self.amqp_consumer = self.amqp_client.new_consuming_queue()
 
+        # Time from the reception of a frame to its publication: a frame which is late is not
+        # inferred, or not waited for, and gets the last inference result instead. Disabled if 0.
+        self.frame_deadline = float(os.getenv('FRAME_DEADLINE_MS', '0')) / 1000 or None
+
+        # Time to wait for the response of a worker before taking it out of rotation, forever if 0,
+        # and to wait before sending it commands again, doubled at each consecutive failure.
+        # A worker that is dead or far slower than usual only stops getting commands with a timeout:
+        # by default, 10 frame deadlines as a later result is too stale to stand for the next frames.
+        default_timeout = 10 * self.frame_deadline if self.frame_deadline is not None else 10.
+        self.worker_timeout = float(os.getenv('WORKER_TIMEOUT_MS', default_timeout * 1000)) / 1000 or None
+        self.worker_retry_delay = float(os.getenv('WORKER_RETRY_MS', '5000')) / 1000
+
+        # Number of inference commands each worker may be processing at once
+        self.max_in_flight_requests = int(os.getenv('MAX_IN_FLIGHT_REQUESTS', '4'))
+
+        # Reuse of the inference results of near-duplicate frames, disabled if the cache size is 0:
+        # maximum Hamming distance between the 64 bits perceptual hashes and lifetime of the results
+        self.result_cache_size = int(os.getenv('RESULT_CACHE_SIZE', '0'))
+        self.result_cache_max_distance = int(os.getenv('RESULT_CACHE_MAX_DISTANCE', '4'))
+        self.result_cache_ttl = float(os.getenv('RESULT_CACHE_TTL_MS', '10000')) / 1000
+
+        # Move the boxes of the last inference result on the frames which are not inferred, from their
+        # motion between the last two results: minimum IoU of the boxes of a same object in these results
+        self.track_boxes = os.getenv('TRACK_BOXES') == "1"
+        self.track_min_iou = float(os.getenv('TRACK_MIN_IOU', '0.3'))
+
+        # Workers of the image pre and post processing, which runs on the event loop if there are none
+        self.image_pool_threads = int(os.getenv('IMAGE_POOL_THREADS', '0'))
+        self.image_pool_processes = int(os.getenv('IMAGE_POOL_PROCESSES', '0'))
+
+        # Port of the metrics scrape endpoint, disabled if 0
+        self.metrics_port = int(os.getenv('METRICS_PORT', '0'))
+
+        # Fraction of the frames whose stage timings are logged
+        self.trace_sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+
+# --------------------------------------------------------------------------- #
+
+class Stream(object):
+    """
+    State of one stream of frames, from a NATS source topic to its destination topic
+    """
+
+    def __init__(self, config, src_topic):
+        self.src_topic = src_topic
+
+        # Setup the drawing of the results, rendered once per inference result
+        self.overlay_renderer = draw.OverlayRenderer(hcentrate=True, valign=1, draw_only_first_tag=True)
+
+        # Setup the selection of frames to process
+        if config.target_inference_fps is None:
+            self.sampler = FixedFrameSampler(config.process_each_n_frames)
+        else:
+            self.sampler = AdaptiveFrameSampler(
+                config.target_inference_fps, config.latency_budget,
+                min_n_frames=config.min_process_each_n_frames,
+                max_n_frames=config.max_process_each_n_frames,
+                max_in_flight=config.max_in_flight_requests * len(config.command_queue_names))
+
+        # Setup the gating of the frames to process by the change of the scene
+        self.motion_gate = None
+        if config.motion_threshold is not None:
+            self.motion_gate = MotionGate(config.motion_threshold, config.motion_max_staleness)
+
+        # Setup the cache of the inference results of the stream
+        self.result_cache = None
+        if config.result_cache_size > 0:
+            self.result_cache = ResultCache(config.result_cache_size, config.result_cache_max_distance, config.result_cache_ttl)
+
+        # Metrics of the stream
+        label = str(src_topic)
+        self.frames_inferred = metrics.FRAMES_INFERRED.labels(label)
+        self.frames_skipped = metrics.FRAMES_SKIPPED.labels(label)
+        self.frames_static = metrics.FRAMES_STATIC.labels(label)
+        self.frames_published = metrics.FRAMES_PUBLISHED.labels(label)
+        self.frames_failed = metrics.FRAMES_FAILED.labels(label)
+        self.frames_expired_queue = metrics.FRAMES_EXPIRED.labels(label, 'queue')
+        self.frames_expired_inference = metrics.FRAMES_EXPIRED.labels(label, 'inference')
+        self.result_cache_hits = metrics.RESULT_CACHE_HITS.labels(label)
+        self.result_cache_misses = metrics.RESULT_CACHE_MISSES.labels(label)
+
+        self.image_counter = 0
+        self.last_inference_result = None  # future of the last inference result
+        self.last_inference_index = None  # index of the frame of the last inference result
+        self.last_result = None  # last inference result received, the fallback of the frames which are late
+        self.tracks = None  # future of the tracks of the boxes of the last inference result, if they move
+        self.last_publish = None  # task publishing the last received frame
+
+# --------------------------------------------------------------------------- #
+
+async def acquire_before(semaphore, deadline):
+    """
+    Acquire a semaphore unless it takes until `deadline`, on the monotonic clock,
+    and return whether it was acquired. Without a deadline, wait as long as needed.
+    """
+    if deadline is None or not semaphore.locked():
+        await semaphore.acquire()
+        return True
+    try:
+        await asyncio.wait_for(semaphore.acquire(), max(deadline - time.monotonic(), 0))
+        return True
+    except asyncio.TimeoutError:
+        return False
+
 # --------------------------------------------------------------------------- #
 
 class MessageHandler(object):
+    """
+    Serves all the streams of the NATS helper with a single neural worker
+    """
 
-    def __init__(self, config):
+    def __init__(self, config, nats_helper=None):
         self._config = config
 
         # Setup Nutanix NATS client
-        self._nats_helper = NATSHelper()
+        self._nats_helper = NATSHelper() if nats_helper is None else nats_helper
+
+        # Setup the non-blocking inference client, shared by all streams
+        self._inference_helper = InferenceHelper(
+            config.amqp_client, config.command_queue_names,
+            config.amqp_response_queue, config.amqp_consumer,
+            max_in_flight=config.max_in_flight_requests,
+            timeout=config.worker_timeout,
+            retry_delay=config.worker_retry_delay)
+
+        # Setup the encoding of the results
+        self._serializer = ResultSerializer(config.output_format)
+
+        # Setup the image processing off the event loop, one frame being prepared for inference per worker
+        self._pool = WorkerPool(config.image_pool_threads, config.image_pool_processes)
+        self._request_slots = asyncio.Semaphore(self._pool.size)
+
+        # Setup the tracing of a sample of the frames
+        self._tracer = tracing.Tracer(config.trace_sample_rate)
 
-        # Internal state
-        self._image_counter = 0
-        self._last_inference_result = None
+        # Internal state, per source topic
+        self._streams = {}
 
-    def send_inference_request(self, image):
+        # Gauges read when scraped
+        metrics.INGRESS_QUEUE_LENGTH.set_function(lambda: len(self._nats_helper.ingress_queue))
+        metrics.INFERENCE_IN_FLIGHT.set_function(lambda: self._inference_helper.in_flight)
+
+    def get_stream(self, src_topic):
+        stream = self._streams.get(src_topic)
+        if stream is None:
+            stream = self._streams[src_topic] = Stream(self._config, src_topic)
+        return stream
+
+    async def send_inference_request(self, stream, frame):
         """
-        Send an inference command to the neural worker and wait for the result
+        Send an inference command to the neural worker and return a future of its result.
+        This only waits for a free slot in the in-flight window, not for the response,
+        and raises asyncio.TimeoutError if there is none before the deadline of the frame.
         """
-        # Create a recognition command mix
-        command = create_workflow_command_mix()
+        # Downscale to the network resolution and crop: the full resolution is only needed to draw on it.
+        # In another process, the frame is decoded again from its bytes rather than pickled decoded:
+        # the received frames are views of the NATS messages, copied to be pickled.
+        max_size = self._config.inference_max_size
+        aspect_ratio = self._config.crop_aspect_ratio
+        with PREPROCESS.time(frame.trace):
+            if max_size is None and aspect_ratio is None:
+                image, change_of_basis_matrix = frame.to_bytes(), None
+            elif self._pool.n_processes > 0:
+                image, change_of_basis_matrix = await self._pool.run_in_process(
+                    prepare_inference_data, bytes(frame.to_bytes()), max_size, aspect_ratio)
+            else:
+                image, change_of_basis_matrix = await self._pool.run_in_thread(
+                    prepare_inference_image, frame, max_size, aspect_ratio, not self._config.draw_demo)
 
-        if self._config.crop_aspect_ratio is not None:
-            image, change_of_basis_matrix = utils.crop_and_dump(image, self._config.crop_aspect_ratio)
-        else:
-            change_of_basis_matrix = None
-
-        # This assumes a mono-input network
-        image_input = v07_ImageInput(source=b'data:image/*;binary,' + image)
-        inputs = create_images_input_mix([image_input])
+        # Create a recognition command, this assumes a mono-input network
+        command = serialize_image_command(image, create_workflow_command_mix(), self._config.amqp_response_queue.name)
 
         # Send the request
         logger.info("Sending inference request to worker")
-        correlation_id = self._config.amqp_client.command(
-            self._config.command_queue_name,
-            self._config.amqp_response_queue.name, inputs, command)
+        response = await self._inference_helper.send(command, frame.deadline)
+        return asyncio.ensure_future(self.get_inference_result(stream, response, change_of_basis_matrix, time.monotonic(), frame.trace))
 
-        # Wait for response, `timeout=float('inf')` or `timeout=-1` for infinite wait, `timeout=None` for non blocking
-        response = self._config.amqp_consumer.get(correlation_id, timeout=-1)
-        # Put data as returned by Deepomatic API v0.7
-        inference_result = {'outputs': [MessageToDict(o, preserving_proto_field_name=True, including_default_value_fields=True) for o in response.to_parsed_result_buffer()]}
+    async def get_inference_result(self, stream, response, change_of_basis_matrix, sent_at, trace=None):
+        """
+        Wait for the response of the neural worker and convert it
+        """
+        response = await response
+        received_at = time.monotonic()
+        INFERENCE.observe(sent_at, received_at, trace)
+        stream.sampler.record_round_trip(received_at - sent_at)
+
+        with CONVERT.time(trace):
+            # Put data as returned by Deepomatic API v0.7
+            result = response.to_result_buffer()
+            outputs = [MessageToDict(o, preserving_proto_field_name=True, including_default_value_fields=True) for o in parse_result_buffer(result)]
+            inference_result = InferenceResult(outputs, result)
 
-        if change_of_basis_matrix is not None:
-            for prediction in inference_result['outputs'][0]['labels']['predicted']:
-                roi = prediction.get('roi')
-                if roi is not None:
-                    utils.normalize_roi(roi, change_of_basis_matrix)
+            if change_of_basis_matrix is not None:
+                predictions = inference_result['outputs'][0]['labels']['predicted']
+                utils.normalize_rois([p['roi'] for p in predictions if p.get('roi') is not None], change_of_basis_matrix)
 
         logger.info("Got inference response: {}".format(inference_result))
+        stream.last_result = inference_result
         return inference_result
 
-    async def message_handler(self, image):
-        # Perform inference
-        if self._image_counter % self._config.process_each_n_frames == 0:
-            self._last_inference_result = self.send_inference_request(image)
+    async def infer(self, stream, frame):
+        """
+        Send an inference command for a frame and wait for its result
+        """
+        try:
+            inference_result = await self.send_inference_request(stream, frame)
+        finally:
+            self._request_slots.release()
+        return await inference_result
+
+    async def track(self, previous_result, previous_index, inference_result, index):
+        """
+        Return the tracks of the boxes of an inference result, None if it failed
+        """
+        try:
+            current = await inference_result
+        except Exception:
+            return None
+        previous = None
+        if previous_result is not None:
+            try:
+                previous = await previous_result
+            except Exception:
+                pass
+        return Tracks(current, index, previous, previous_index, self._config.track_min_iou)
+
+    @staticmethod
+    async def predict_result(tracks, inference_result, index, trace=None):
+        """
+        Return the last inference result with its boxes moved to the frame `index`
+        """
+        tracks = await tracks
+        if tracks is None:
+            return await inference_result
+        with TRACK.time(trace):
+            return tracks.predict(index)
+
+    @staticmethod
+    async def wait_result(stream, frame, inference_result):
+        """
+        Wait for the inference result of a frame until its deadline, then fall back to the last result received.
+        Return the result and whether it is the fallback.
+        """
+        if frame.deadline is None:
+            return await inference_result, False
+        try:
+            if inference_result is None:
+                raise asyncio.TimeoutError()
+            # Shielded as the result is shared with other frames. The command of a frame which
+            # found no free slot in the in-flight window before its deadline fails with a timeout too.
+            return await asyncio.wait_for(asyncio.shield(inference_result), max(frame.deadline - time.monotonic(), 0)), False
+        except asyncio.TimeoutError:
+            stream.frames_expired_inference.inc()
+            if stream.last_result is None:
+                raise Exception('Frame expired before any inference result')
+            return stream.last_result, True
+
+    @staticmethod
+    def draw_result(stream, frame, inference_result, copy=False):
+        # Draw label on the already decoded image, or on a copy if it may still be read to prepare the inference
+        if copy:
+            frame = frame.copy()
+        frame.image = stream.overlay_renderer.draw(frame.image, inference_result)
+        return frame.to_bytes()
+
+    async def publish_result(self, stream, frame, inference_result, previous_publish):
+        # Frames of a stream are processed concurrently but published in input order
+        payload = None
+        try:
+            inference_result, fallback = await self.wait_result(stream, frame, inference_result)
+
+            if self._config.draw_demo:
+                with DRAW.time(frame.trace):
+                    payload = await self._pool.run_in_thread(self.draw_result, stream, frame, inference_result, fallback)
+            else:
+                # Encoded once per inference result
+                with SERIALIZE.time(frame.trace):
+                    payload = self._serializer.serialize(inference_result)
+        except Exception as e:
+            # Catch an display errors which are otherwise not shown
+            logger.error("{}".format(e))
+
+        # Wait for the previous frame, its own errors are logged by its task
+        if previous_publish is not None:
+            await asyncio.wait([previous_publish])
+
+        try:
+            if payload is not None:
+                with PUBLISH.time(frame.trace):
+                    await self._nats_helper.publish(payload, stream.src_topic, frame.source)
+                stream.frames_published.inc()
+                if frame.source is not None:
+                    tracing.record_frame_latency(frame.source.timestamp)
+                if frame.trace is not None:
+                    frame.trace.finish()
+            else:
+                stream.frames_failed.inc()
+        except Exception as e:
+            # Catch an display errors which are otherwise not shown
+            logger.error("{}".format(e))
+            stream.frames_failed.inc()
+        finally:
+            metrics.FRAMES_IN_PROGRESS.dec()
+
+    @staticmethod
+    def should_process(stream, frame):
+        """
+        Whether to infer a frame rather than publish it with the last inference result
+        """
+        if not stream.sampler.should_process():
+            return False
+        if stream.motion_gate is not None and not stream.motion_gate.should_process(frame):
+            # The scene did not change: the boxes do not move
+            stream.tracks = None
+            stream.frames_static.inc()
+            return False
+        return True
+
+    @staticmethod
+    def get_cached_result(stream, frame):
+        """
+        Return the hash of a frame and the cached result of a near-duplicate frame, None if there is none
+        """
+        image_hash = stream.result_cache.get_hash(frame)
+        inference_result = stream.result_cache.get(image_hash)
+        if inference_result is None:
+            stream.result_cache_misses.inc()
+        else:
+            stream.result_cache_hits.inc()
+        return image_hash, inference_result
+
+    async def acquire_request_slot(self, stream, frame):
+        """
+        Wait for a free slot to prepare and send the inference request of a frame, until its deadline.
+        Return False if the frame expired first.
+        """
+        if frame.deadline is not None and time.monotonic() >= frame.deadline:
+            acquired = False
+        else:
+            acquired = await acquire_before(self._request_slots, frame.deadline)
+        if not acquired:
+            stream.frames_expired_queue.inc()
+        return acquired
+
+    async def message_handler(self, image, src_topic=None, source=None, received_at=None):
+        stream = self.get_stream(src_topic)
+
+        # Decoded with the codec of the drawing backend so that pixels can be drawn on directly
+        frame = Frame(image, draw.BACKEND.decode_img, draw.BACKEND.encode_img)
+        frame.source = source
+        frame.trace = self._tracer.start(str(src_topic), source.timestamp if source is not None else 0)
+        if self._config.frame_deadline is not None:
+            frame.deadline = (time.monotonic() if received_at is None else received_at) + self._config.frame_deadline
 
-        if self._config.draw_demo:
-            # Draw label on the image
-            payload = draw_predictions(image, self._last_inference_result, hcentrate=True, valign=1, draw_only_first_tag=True)
+        # Perform inference, waiting for a free slot so that frames are buffered in the ingress queue,
+        # unless a near-duplicate frame was inferred recently or the frame is already late
+        index = stream.image_counter
+        cached_result = None
+        inference_result = None
+        if self.should_process(stream, frame):
+            if stream.result_cache is not None:
+                image_hash, cached_result = self.get_cached_result(stream, frame)
+            if cached_result is not None:
+                # The scene did not change: the boxes do not move
+                inference_result = cached_result
+                stream.tracks = None
+                stream.frames_skipped.inc()
+            elif await self.acquire_request_slot(stream, frame):
+                inference_result = asyncio.ensure_future(self.infer(stream, frame))
+                # Its failure is reported by the frames waiting for it, which may all have given up at their deadline
+                inference_result.add_done_callback(lambda f: f.cancelled() or f.exception())
+                if stream.result_cache is not None:
+                    stream.result_cache.put(image_hash, inference_result)
+                if self._config.track_boxes:
+                    stream.tracks = asyncio.ensure_future(self.track(
+                        stream.last_inference_result, stream.last_inference_index, inference_result, index))
+                stream.frames_inferred.inc()
+            if inference_result is not None:
+                stream.last_inference_result = inference_result
+                stream.last_inference_index = index
+            else:
+                stream.frames_skipped.inc()
         else:
-            payload = json.dumps(self._last_inference_result).encode('utf8')
+            stream.frames_skipped.inc()
 
-        # Increment counter and send the result
-        self._image_counter += 1
-        await self._nats_helper.publish(payload)
+        # Frames which are not inferred get the last result, with its boxes moved along their tracks
+        if inference_result is None:
+            inference_result = stream.last_inference_result
+            if stream.tracks is not None:
+                inference_result = asyncio.ensure_future(self.predict_result(stream.tracks, inference_result, index, frame.trace))
+
+        # Increment counter and send the result once available, in the order of the stream
+        stream.image_counter += 1
+        metrics.FRAMES_IN_PROGRESS.inc()
+        stream.last_publish = asyncio.ensure_future(
+            self.publish_result(stream, frame, inference_result, stream.last_publish))
 
     def run_forever(self):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self._nats_helper.connect(loop, self.message_handler))
+        if self._config.metrics_port:
+            loop.run_until_complete(metrics.REGISTRY.serve(self._config.metrics_port))
         try:
             loop.run_forever()
         finally:
-            self._nats_helper.close()
+            self.close()
             loop.close()
 
+    def close(self):
+        self._inference_helper.close()
+        self._pool.close()
+        self._nats_helper.close()
+
 
 # --------------------------------------------------------------------------- #
 
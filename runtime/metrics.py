@@ -0,0 +1,224 @@
+import time
+import bisect
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------- #
+
+class Metric(object):
+    """
+    A metric exposed in the Prometheus text format. Labelled metrics have one child
+    per label values: get it once with `labels(...)` to keep the hot path to a single update.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = OrderedDict()  # label values -> child
+        if not self.labelnames:
+            self._child = self.labels()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise Exception('Metric {n} expects labels {l}'.format(n=self.name, l=', '.join(self.labelnames)))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _format_labels(self, values, extra=()):
+        labels = list(zip(self.labelnames, values)) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for values, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                lines.append('{}{}{} {}'.format(self.name, suffix, self._format_labels(values, extra), repr(float(value))))
+        return lines
+
+class ValueChild(object):
+    def __init__(self):
+        self.value = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        Read the value from `function` when scraped rather than updating it
+        """
+        self._function = function
+
+    def get(self):
+        return self.value if self._function is None else self._function()
+
+    def samples(self):
+        return [('', (), self.get())]
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return ValueChild()
+
+    def inc(self, amount=1):
+        self._child.inc(amount)
+
+    def total(self):
+        """
+        Sum of the values of all the children
+        """
+        return sum(child.get() for child in list(self._children.values()))
+
+    def set_function(self, function):
+        self._child.set_function(function)
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def dec(self, amount=1):
+        self._child.dec(amount)
+
+    def set(self, value):
+        self._child.set(value)
+
+class Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.monotonic()
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.monotonic() - self._start)
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulated = 0
+        for bound, count in zip(self._buckets + ('+Inf',), self._counts):
+            cumulated += count
+            samples.append(('_bucket', (('le', bound if bound == '+Inf' else repr(float(bound))),), cumulated))
+        samples.append(('_sum', (), self.sum))
+        samples.append(('_count', (), self.count))
+        return samples
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._child.observe(value)
+
+    def time(self):
+        return self._child.time()
+
+# --------------------------------------------------------------------------- #
+
+class Registry(object):
+    """
+    Collects the metrics and serves them on a scrape endpoint
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise Exception('Metric {} is already registered'.format(metric.name))
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1].decode() if len(request.split()) > 1 else '/'
+            if path.split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'.format(status, len(body)).encode())
+            writer.write(body)
+            await writer.drain()
+        except Exception as e:
+            logger.error("{}".format(e))
+        finally:
+            writer.close()
+
+    async def serve(self, port, host='0.0.0.0'):
+        logger.info("Serving metrics on port {}".format(port))
+        return await asyncio.start_server(self.handle_request, host, port)
+
+REGISTRY = Registry()
+
+# --------------------------------------------------------------------------- #
+# Runtime metrics
+
+STAGE_LATENCY = Histogram('runtime_stage_latency_seconds', 'Latency of the pipeline stages', ['stage'])
+
+FRAMES_RECEIVED = Counter('runtime_frames_received_total', 'Frames received from NATS', ['stream'])
+FRAMES_DROPPED = Counter('runtime_frames_dropped_total', 'Frames dropped by the ingress queue', ['stream'])
+FRAMES_INFERRED = Counter('runtime_frames_inferred_total', 'Frames sent to inference', ['stream'])
+FRAMES_SKIPPED = Counter('runtime_frames_skipped_total', 'Frames published with the result of a previous frame', ['stream'])
+FRAMES_PUBLISHED = Counter('runtime_frames_published_total', 'Frames published to NATS', ['stream'])
+FRAMES_STATIC = Counter('runtime_frames_static_total', 'Frames not inferred as the scene did not change', ['stream'])
+RESULT_CACHE_HITS = Counter('runtime_result_cache_hits_total', 'Frames to infer given the cached result of a near-duplicate frame', ['stream'])
+RESULT_CACHE_MISSES = Counter('runtime_result_cache_misses_total', 'Frames to infer without a cached result of a near-duplicate frame', ['stream'])
+FRAMES_EXPIRED = Counter('runtime_frames_expired_total', 'Frames published with the result of a previous frame as their deadline passed, before inference or while waiting for it', ['stream', 'stage'])
+FRAMES_FAILED = Counter('runtime_frames_failed_total', 'Frames which could not be published', ['stream'])
+
+INGRESS_QUEUE_LENGTH = Gauge('runtime_ingress_queue_length', 'Frames waiting in the ingress queue')
+FRAMES_IN_PROGRESS = Gauge('runtime_frames_in_progress', 'Frames handled but not published yet')
+INFERENCE_IN_FLIGHT = Gauge('runtime_inference_in_flight', 'Inference commands waiting for a response')
+WORKER_OUTSTANDING = Gauge('runtime_worker_outstanding', 'Inference commands waiting for a response, per worker command queue', ['queue'])
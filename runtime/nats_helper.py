@@ -1,30 +1,171 @@
 import os
+import zlib
+import time
+import socket
 import logging
 import asyncio
+from collections import deque, Counter, OrderedDict
 
 from nats.aio.client import Client as NATS
 
 from proto import xi_iot_pb2
+import metrics
+import tracing
+import wire
 
 logger = logging.getLogger(__name__)
 
+PARSE = tracing.Stage('parse')
+
+PAYLOAD_FIELD = xi_iot_pb2.DataStreamMessage.DESCRIPTOR.fields_by_name['payload'].number
+
+# --------------------------------------------------------------------------- #
+
+class IngressQueue(object):
+    """
+    Bounded buffer between the NATS subscription and the message handler.
+    When full, the overflow policy decides which frame is dropped:
+    - drop_oldest: the oldest buffered frame is discarded
+    - drop_newest: the incoming frame is discarded
+    - latest: only the most recent frame of each stream is kept
+    A `maxsize` of 0 means unbounded (and nothing is ever dropped for FIFO policies).
+    """
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    LATEST = 'latest'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, LATEST)
+
+    def __init__(self, maxsize=0, policy=DROP_OLDEST):
+        if policy not in self.POLICIES:
+            raise Exception('Unknown ingress policy {p}, should be one of: {l}'.format(p=policy, l=', '.join(self.POLICIES)))
+        self.maxsize = maxsize
+        self.policy = policy
+
+        # Counters
+        self.received = 0
+        self.dropped = 0
+        self.dropped_by_stream = Counter()
+
+        if policy == self.LATEST:
+            self._items = OrderedDict()  # stream -> item
+        else:
+            self._items = deque()  # (stream, item)
+        self._not_empty = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items)
+
+    def full(self):
+        return self.maxsize > 0 and len(self._items) >= self.maxsize
+
+    def _drop(self, stream):
+        self.dropped += 1
+        self.dropped_by_stream[stream] += 1
+        metrics.FRAMES_DROPPED.labels(stream).inc()
+        logger.debug("Dropped a frame from stream '{}'".format(stream))
+
+    def put(self, stream, item):
+        """
+        Buffer an item without blocking, dropping a frame if needed
+        """
+        self.received += 1
+        metrics.FRAMES_RECEIVED.labels(stream).inc()
+        if self.policy == self.LATEST:
+            if stream in self._items:
+                self._drop(stream)
+            elif self.full():
+                self._drop(self._items.popitem(last=False)[0])
+            self._items[stream] = item
+        else:
+            if self.full():
+                if self.policy == self.DROP_NEWEST:
+                    self._drop(stream)
+                    return
+                self._drop(self._items.popleft()[0])
+            self._items.append((stream, item))
+        self._not_empty.set()
+
+    async def get(self):
+        """
+        Wait for and return the next item
+        """
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        if self.policy == self.LATEST:
+            _, item = self._items.popitem(last=False)
+        else:
+            _, item = self._items.popleft()
+        return item
+
 # --------------------------------------------------------------------------- #
 
 class NATSHelper(object):
+    """
+    Receives frames from one or several NATS source topics and publishes the results
+    to their destination topic. The streams are given as `nats_topics`, a list of
+    (source, destination) pairs or a `src1:dst1,src2:dst2` string, and default to the
+    single NATS_SRC_TOPIC -> NATS_DST_TOPIC stream.
 
-    def __init__(self, nats_broker_url=None, nats_src_topic=None, nats_dst_topic=None):
-        self.subscribe_id = None
+    Several replicas of the runtime share the work in one of two ways:
+    - with a `nats_queue_group`, each frame is delivered to a single replica of the group:
+      one stream scales with the replicas but the replicas publish their frames independently,
+      so the order of a stream is only kept within each replica
+    - with `replicas` > 1, the streams are split between the replicas, each one only subscribing
+      to its own streams: the order of each stream is kept. The index of the replica defaults
+      to the ordinal of the StatefulSet pod, from the hostname.
+    Both require the replicas to connect to the same NATS broker, not to a broker of their own.
+    """
+
+    def __init__(self, nats_broker_url=None, nats_src_topic=None, nats_dst_topic=None, ingress_queue_size=None, ingress_policy=None, nats_topics=None,
+                 nats_queue_group=None, replicas=None, replica_index=None):
+        self.subscribe_ids = []
         self.connected = False
         self.nats_client = NATS()
+        self._ingress_task = None
 
         self._get_config_from_env_var_('nats_broker_url', 'NATS_ENDPOINT', nats_broker_url, 'NATS broker')
-        self._get_config_from_env_var_('nats_src_topic', 'NATS_SRC_TOPIC', nats_src_topic, 'NATS source topic')
-        self._get_config_from_env_var_('nats_dst_topic', 'NATS_DST_TOPIC', nats_dst_topic, 'NATS destination topic')
 
-        logger.info("broker: {b}, src topic: {s}, dst_topic: {d}".format(
+        # Source topic -> destination topic
+        if nats_topics is None and nats_src_topic is None and nats_dst_topic is None:
+            nats_topics = os.getenv('NATS_TOPICS') or None
+        if nats_topics is None:
+            self._get_config_from_env_var_('nats_src_topic', 'NATS_SRC_TOPIC', nats_src_topic, 'NATS source topic')
+            self._get_config_from_env_var_('nats_dst_topic', 'NATS_DST_TOPIC', nats_dst_topic, 'NATS destination topic')
+            self.topics = OrderedDict([(self.nats_src_topic, self.nats_dst_topic)])
+        else:
+            self.topics = self.parse_topics(nats_topics)
+            # The first stream is the default one
+            self.nats_src_topic, self.nats_dst_topic = next(iter(self.topics.items()))
+
+        # Share the work with the other replicas
+        if nats_queue_group is None:
+            nats_queue_group = os.getenv('NATS_QUEUE_GROUP', '')
+        self.nats_queue_group = nats_queue_group
+        if replicas is None:
+            replicas = int(os.getenv('REPLICAS', '1'))
+        if replicas > 1:
+            if replica_index is None:
+                replica_index = self.get_replica_index()
+            if not 0 <= replica_index < replicas:
+                raise Exception('Invalid replica index {i} for {n} replicas'.format(i=replica_index, n=replicas))
+            self.subscribed_topics = [t for t in self.topics if self.get_topic_replica(t, replicas) == replica_index]
+            if not self.subscribed_topics:
+                logger.warning("No stream to process for replica {i} of {n}".format(i=replica_index, n=replicas))
+        else:
+            self.subscribed_topics = list(self.topics)
+
+        # Buffer frames between reception and processing, defaults to an unbounded queue
+        if ingress_queue_size is None:
+            ingress_queue_size = int(os.getenv('INGRESS_QUEUE_SIZE', '0'))
+        if ingress_policy is None:
+            ingress_policy = os.getenv('INGRESS_POLICY', IngressQueue.DROP_OLDEST)
+        self.ingress_queue = IngressQueue(ingress_queue_size, ingress_policy)
+
+        logger.info("broker: {b}, topics: {t}".format(
             b=self.nats_broker_url,
-            s=self.nats_src_topic,
-            d=self.nats_dst_topic))
+            t=', '.join('{} -> {}'.format(s, d) for s, d in self.topics.items())))
 
     def __del__(self):
         self.close()
@@ -38,66 +179,143 @@ class NATSHelper(object):
             raise Exception('{what} not provided in environment var {var}'.format(what=what, var=var))
         setattr(self, attr, value)
 
+    @staticmethod
+    def parse_topics(nats_topics):
+        """
+        Convert a `src1:dst1,src2:dst2` string or a list of pairs into an ordered mapping
+        """
+        if isinstance(nats_topics, str):
+            pairs = []
+            for pair in nats_topics.split(','):
+                pair = pair.strip()
+                if not pair:
+                    continue
+                if pair.count(':') != 1:
+                    raise Exception('Invalid NATS topics {}, should be source:destination'.format(pair))
+                pairs.append(tuple(t.strip() for t in pair.split(':')))
+            nats_topics = pairs
+        topics = OrderedDict()
+        for src, dst in nats_topics:
+            if not src or not dst:
+                raise Exception('Empty NATS topic in {}:{}'.format(src, dst))
+            if src in topics:
+                raise Exception('NATS source topic {} is given twice'.format(src))
+            topics[src] = dst
+        if not topics:
+            raise Exception('No NATS topics provided')
+        return topics
+
+    @staticmethod
+    def get_replica_index():
+        """
+        Read the replica index from REPLICA_INDEX or from the hostname of a StatefulSet pod: <name>-<ordinal>
+        """
+        replica_index = os.getenv('REPLICA_INDEX')
+        if replica_index is None:
+            replica_index = socket.gethostname().rsplit('-', 1)[-1]
+            if not replica_index.isdigit():
+                raise Exception('Replica index not provided in environment var REPLICA_INDEX nor in hostname')
+        return int(replica_index)
+
+    @staticmethod
+    def get_topic_replica(src_topic, replicas):
+        """
+        Index of the replica processing a stream, stable across processes
+        """
+        return zlib.crc32(src_topic.encode()) % replicas
+
     @staticmethod
     def payload_from_message(msg):
         """
-        Convert input payload into an image
+        Convert input payload into an image and the message it was received in,
+        without its payload: its capture timestamp and the metadata of the data source.
+        The image is a memoryview of the message data, only the other fields are parsed.
         """
+        payload, others = wire.split_field(msg.data, PAYLOAD_FIELD)
         _msg = xi_iot_pb2.DataStreamMessage()
-        _msg.ParseFromString(msg.data)
-        return _msg.payload
+        _msg.ParseFromString(others)
+        return payload if payload is not None else b'', _msg
 
     @staticmethod
-    def message_from_payload(payload):
+    def message_from_payload(payload, source=None):
         """
-        Convert image into output payload
+        Convert image into output payload, with the timestamp and metadata of the source message if given
         """
         msg = xi_iot_pb2.DataStreamMessage()
+        if source is not None:
+            msg.timestamp = source.timestamp
+            if source.HasField('metaData'):
+                msg.metaData.CopyFrom(source.metaData)
         msg.payload = payload
         return msg.SerializeToString()
 
-    async def publish(self, payload):
+    async def publish(self, payload, src_topic=None, source=None):
+        """
+        Publish to the destination topic of the stream received on `src_topic`
+        (the default stream if not given). `source` is the message the frame was received in.
+        """
         try:
-            payload = self.message_from_payload(payload)
+            dst_topic = self.nats_dst_topic if src_topic is None else self.topics[src_topic]
+            payload = self.message_from_payload(payload, source)
             # RFC: We could leverage `reply` topic as the destination topic which would not require NATS_DST_TOPIC to be provided
             # await nc.publish(reply, data)
-            logger.info("Sending message to topic '{}'".format(self.nats_dst_topic))
-            await self.nats_client.publish(self.nats_dst_topic, payload)
+            logger.info("Sending message to topic '{}'".format(dst_topic))
+            await self.nats_client.publish(dst_topic, payload)
         except Exception as e:
             # Catch an display errors which are otherwise not shown
             logger.error("{}".format(e))
             raise
 
-    async def connect(self, loop, message_handler_cb):
-        # Define a helper function to unbox the message and catch errors for display
-        async def receive_cb(msg):
+    async def process_ingress_queue(self, message_handler_cb):
+        """
+        Unbox the buffered messages and hand them to the message handler one at a time,
+        along with the source topic of their stream, their source message and the time they were received at
+        """
+        while True:
+            src_topic, msg, received_at = await self.ingress_queue.get()
             try:
-                logger.info("Received a message!")
-                payload = self.payload_from_message(msg)
-                await message_handler_cb(payload)
+                with PARSE.time():
+                    payload, source = self.payload_from_message(msg)
+                await message_handler_cb(payload, src_topic, source, received_at)
             except Exception as e:
                 # Catch an display errors which are otherwise not shown
                 logger.error("{}".format(e))
-                raise
+
+    async def connect(self, loop, message_handler_cb):
+        # Define a helper function per stream to buffer the message, it is unboxed only if not dropped
+        def make_receive_cb(src_topic):
+            async def receive_cb(msg):
+                logger.info("Received a message on topic '{}'".format(src_topic))
+                self.ingress_queue.put(src_topic, (src_topic, msg, time.monotonic()))
+            return receive_cb
+
+        self._ingress_task = loop.create_task(self.process_ingress_queue(message_handler_cb))
 
         try:
             # This will return immediately if the server is not listening on the given URL
             await self.nats_client.connect(self.nats_broker_url, loop=loop)
             self.connected = True
-            logger.info("Connected to broker, subscribing to topic '{}'".format(self.nats_src_topic))
 
-            self.subscribe_id = await self.nats_client.subscribe(self.nats_src_topic, cb=receive_cb)
+            for src_topic in self.subscribed_topics:
+                logger.info("Connected to broker, subscribing to topic '{}'".format(src_topic))
+                subscribe_id = await self.nats_client.subscribe(
+                    src_topic, queue=self.nats_queue_group, cb=make_receive_cb(src_topic))
+                self.subscribe_ids.append(subscribe_id)
         except Exception as e:
             # Catch an display errors which are otherwise not shown
             logger.error("{}".format(e))
             raise
 
     def close(self):
-        # Remove interest in subscription.
+        if self._ingress_task is not None:
+            self._ingress_task.cancel()
+            self._ingress_task = None
+
+        # Remove interest in subscriptions.
         loop = asyncio.get_event_loop()
-        if self.subscribe_id is not None:
-            loop.run_until_complete(self.nats_client.unsubscribe(self.subscribe_id))
-            self.subscribe_id = None
+        subscribe_ids, self.subscribe_ids = self.subscribe_ids, []
+        for subscribe_id in subscribe_ids:
+            loop.run_until_complete(self.nats_client.unsubscribe(subscribe_id))
 
         # Terminate connection to NATS.
         if self.nats_client is not None and self.connected:
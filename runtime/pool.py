@@ -0,0 +1,46 @@
+import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------- #
+
+class WorkerPool(object):
+    """
+    Runs the CPU bound image work off the event loop.
+    Threads suit the codec and pixel calls of PIL and OpenCV which release the GIL,
+    processes suit the work which holds it. The functions run in processes are given
+    encoded images so that only compact bytes are pickled between processes.
+    Without threads (resp. processes), the work runs in threads (resp. on the event loop).
+    """
+
+    def __init__(self, n_threads=0, n_processes=0):
+        self.n_threads = n_threads
+        self.n_processes = n_processes
+        self._threads = ThreadPoolExecutor(n_threads) if n_threads > 0 else None
+        self._processes = ProcessPoolExecutor(n_processes) if n_processes > 0 else None
+
+    @property
+    def size(self):
+        """
+        Number of jobs running at once in the pool
+        """
+        return max(self.n_processes, self.n_threads, 1)
+
+    async def run_in_thread(self, fn, *args):
+        if self._threads is None:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(self._threads, fn, *args)
+
+    async def run_in_process(self, fn, *args):
+        if self._processes is None:
+            return await self.run_in_thread(fn, *args)
+        return await asyncio.get_event_loop().run_in_executor(self._processes, fn, *args)
+
+    def close(self):
+        for executor in (self._threads, self._processes):
+            if executor is not None:
+                executor.shutdown(wait=False)
+        self._threads = None
+        self._processes = None
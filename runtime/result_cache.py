@@ -0,0 +1,82 @@
+import time
+import asyncio
+import logging
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------- #
+
+def difference_hash(thumbnail):
+    """
+    Perceptual hash of a grayscale thumbnail of shape (h, w + 1): one bit per pair of
+    horizontally adjacent pixels, set if the brightness increases, as an integer of h * w bits
+    """
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+def failed(result):
+    return isinstance(result, asyncio.Future) and result.done() and (result.cancelled() or result.exception() is not None)
+
+# --------------------------------------------------------------------------- #
+
+class ResultCache(object):
+    """
+    Inference results of recent frames, keyed by the perceptual hash of the frames:
+    a frame within `max_distance` bits of a cached one reuses its result. At most
+    `max_size` results are kept, the least recently used ones being evicted first,
+    and none is reused more than `ttl` seconds after its frame was inferred.
+    The results may be futures, a failed one being evicted when found.
+    """
+
+    def __init__(self, max_size=16, max_distance=4, ttl=10., hash_size=8):
+        if max_size < 1:
+            raise Exception('Invalid result cache size {}'.format(max_size))
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.thumbnail_size = (hash_size + 1, hash_size)
+        self._entries = OrderedDict()  # hash -> (inference result, time), most recently used last
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_hash(self, frame):
+        return difference_hash(frame.thumbnail(self.thumbnail_size))
+
+    def _evict_invalid(self, now):
+        invalid = [h for h, (result, t) in self._entries.items() if now - t > self.ttl or failed(result)]
+        for h in invalid:
+            del self._entries[h]
+
+    def get(self, image_hash, now=None):
+        """
+        Return the result of the nearest cached frame within the distance threshold, None if there is none
+        """
+        now = time.monotonic() if now is None else now
+        self._evict_invalid(now)
+
+        best_hash, best_distance = None, self.max_distance + 1
+        for h in self._entries:
+            distance = hamming_distance(image_hash, h)
+            if distance < best_distance:
+                best_hash, best_distance = h, distance
+                if distance == 0:
+                    break
+
+        if best_hash is None:
+            return None
+        self._entries.move_to_end(best_hash)
+        logger.debug("Reusing the result of a frame at distance {}".format(best_distance))
+        return self._entries[best_hash][0]
+
+    def put(self, image_hash, inference_result, now=None):
+        now = time.monotonic() if now is None else now
+        self._entries[image_hash] = (inference_result, now)
+        self._entries.move_to_end(image_hash)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
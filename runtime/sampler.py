@@ -0,0 +1,118 @@
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------- #
+
+class FixedFrameSampler(object):
+    """
+    Sends one frame every `n_frames` to inference
+    """
+
+    def __init__(self, n_frames):
+        self.n_frames = n_frames
+        self._counter = 0
+
+    def should_process(self, now=None):
+        process = self._counter % self.n_frames == 0
+        self._counter += 1
+        return process
+
+    def record_round_trip(self, round_trip_time):
+        pass
+
+# --------------------------------------------------------------------------- #
+
+class AdaptiveFrameSampler(object):
+    """
+    Chooses the frames to send to inference from the measured input frame rate
+    and worker round-trip time. It aims at `target_fps` inferences per second,
+    never faster than the worker sustains with `max_in_flight` pending commands,
+    and backs off while the round-trip time exceeds `latency_budget` (in seconds).
+    The number of frames between two inferences stays in [min_n_frames, max_n_frames].
+    """
+
+    SMOOTHING = 0.1      # Weight of a new measure in the moving averages
+    BACKOFF = 1.5        # Growth of the inference interval when over budget
+    RECOVERY = 0.9       # Decay of the backoff when back under budget
+    MAX_BACKOFF = 100.
+
+    def __init__(self, target_fps, latency_budget, min_n_frames=1, max_n_frames=300, max_in_flight=1):
+        if min_n_frames < 1 or max_n_frames < min_n_frames:
+            raise Exception('Invalid frame sampling bounds [{}, {}]'.format(min_n_frames, max_n_frames))
+        self._target_interval = 1. / target_fps
+        self._latency_budget = latency_budget
+        self._min_n_frames = min_n_frames
+        self._max_n_frames = max_n_frames
+        self._max_in_flight = max_in_flight
+
+        self.n_frames = min_n_frames
+        self.input_period = None       # Moving average of the time between two frames
+        self.round_trip_time = None    # Moving average of the worker round-trip time
+        self._interval = self._target_interval  # Wanted time between two inferences
+        self._backoff = 1.
+        self._last_frame_time = None
+        self._frames_since_inference = None
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.SMOOTHING * (value - average)
+
+    def should_process(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last_frame_time is not None:
+            self.input_period = self._average(self.input_period, now - self._last_frame_time)
+        self._last_frame_time = now
+
+        if self.input_period:
+            n_frames = int(round(self._interval / self.input_period))
+            self.n_frames = min(max(n_frames, self._min_n_frames), self._max_n_frames)
+
+        if self._frames_since_inference is None or self._frames_since_inference + 1 >= self.n_frames:
+            self._frames_since_inference = 0
+            return True
+        self._frames_since_inference += 1
+        return False
+
+    def record_round_trip(self, round_trip_time):
+        self.round_trip_time = self._average(self.round_trip_time, round_trip_time)
+        if self.round_trip_time > self._latency_budget:
+            self._backoff = min(self._backoff * self.BACKOFF, self.MAX_BACKOFF)
+        else:
+            self._backoff = max(self._backoff * self.RECOVERY, 1.)
+        worker_interval = self.round_trip_time / self._max_in_flight
+        self._interval = max(self._target_interval, worker_interval) * self._backoff
+        logger.debug("Round-trip time: {:.3f}s, inference interval: {:.3f}s".format(self.round_trip_time, self._interval))
+
+# --------------------------------------------------------------------------- #
+
+class MotionGate(object):
+    """
+    Lets a frame through to inference only if the scene changed since the last frame let
+    through: the mean absolute difference of their grayscale thumbnails, in gray levels,
+    is at least `threshold`. A frame is let through anyway after `max_staleness` seconds.
+    """
+
+    THUMBNAIL_SIZE = (32, 24)
+
+    def __init__(self, threshold, max_staleness, thumbnail_size=THUMBNAIL_SIZE):
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.thumbnail_size = thumbnail_size
+        self.difference = None  # with the reference frame, of the last frame checked
+        self._reference = None  # thumbnail of the last frame let through
+        self._reference_time = None
+
+    def should_process(self, frame, now=None):
+        now = time.monotonic() if now is None else now
+        thumbnail = frame.thumbnail(self.thumbnail_size)
+        if self._reference is not None:
+            self.difference = np.abs(thumbnail.astype(np.int16) - self._reference).mean()
+            if self.difference < self.threshold and now - self._reference_time < self.max_staleness:
+                return False
+        self._reference = thumbnail.astype(np.int16)
+        self._reference_time = now
+        return True
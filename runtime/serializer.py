@@ -0,0 +1,78 @@
+import json
+
+# --------------------------------------------------------------------------- #
+
+class InferenceResult(dict):
+    """
+    An inference result as returned by Deepomatic API v0.7, along with the protobuf
+    result it was converted from and its encoded forms once they are computed
+    """
+
+    def __init__(self, outputs, proto_result=None):
+        super(InferenceResult, self).__init__(outputs=outputs)
+        self.proto_result = proto_result
+        self.payloads = {}  # output format -> encoded result
+
+# --------------------------------------------------------------------------- #
+
+class ResultSerializer(object):
+    """
+    Encodes inference results in the selected output format:
+    - json: the result as returned by Deepomatic API v0.7
+    - protobuf: the serialized result buffer of the neural worker
+    - msgpack: same content as json in a compact binary format
+    Encoded results are cached on `InferenceResult` objects so that the frames
+    sharing an inference result do not serialize it again.
+    """
+
+    JSON = 'json'
+    PROTOBUF = 'protobuf'
+    MSGPACK = 'msgpack'
+    FORMATS = (JSON, PROTOBUF, MSGPACK)
+
+    def __init__(self, output_format=JSON):
+        if output_format not in self.FORMATS:
+            raise Exception('Unknown output format {f}, should be one of: {l}'.format(f=output_format, l=', '.join(self.FORMATS)))
+        self.output_format = output_format
+
+        if output_format == self.MSGPACK:
+            try:
+                import msgpack
+            except ImportError:
+                raise Exception('msgpack must be installed for the {} output format'.format(output_format))
+            self._encode = lambda result: msgpack.packb(dict(result), use_bin_type=True)
+        elif output_format == self.PROTOBUF:
+            self._encode = self.encode_protobuf
+        else:
+            self._encode = self.encode_json
+
+    @staticmethod
+    def encode_json(inference_result):
+        return json.dumps(inference_result).encode('utf8')
+
+    @staticmethod
+    def encode_protobuf(inference_result):
+        result = getattr(inference_result, 'proto_result', None)
+        if result is None:
+            raise Exception('No protobuf result to serialize')
+
+        # Bounding boxes are normalized in the dict: copy them back to the protobuf result
+        if result.HasField('v07_recognition'):
+            for output, proto_output in zip(inference_result['outputs'], result.v07_recognition.outputs):
+                for prediction, proto_prediction in zip(output['labels']['predicted'], proto_output.labels.predicted):
+                    roi = prediction.get('roi')
+                    if roi is not None:
+                        proto_bbox = proto_prediction.roi.bbox
+                        for key, value in roi['bbox'].items():
+                            setattr(proto_bbox, key, value)
+        return result.SerializeToString()
+
+    def serialize(self, inference_result):
+        payloads = getattr(inference_result, 'payloads', None)
+        if payloads is None:
+            return self._encode(inference_result)
+
+        payload = payloads.get(self.output_format)
+        if payload is None:
+            payload = payloads[self.output_format] = self._encode(inference_result)
+        return payload
@@ -0,0 +1,98 @@
+import time
+import json
+import random
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FRAME_LATENCY = metrics.Histogram('runtime_frame_latency_seconds', 'Latency from the capture of a frame to its publication')
+
+# --------------------------------------------------------------------------- #
+
+class Trace(object):
+    """
+    Spans of the stages of one frame, logged as a JSON line once the frame is published.
+    Times are in seconds since the frame was received, its capture `timestamp`
+    is in nanoseconds since the epoch as set by the data source (0 if unknown).
+    """
+
+    def __init__(self, stream, timestamp=0):
+        self.stream = stream
+        self.timestamp = timestamp
+        self.received_at = time.time()
+        self._start = time.monotonic()
+        self.spans = []  # (stage, start, duration)
+
+    def add_span(self, stage, start, end):
+        self.spans.append((stage, start - self._start, end - start))
+
+    def to_dict(self):
+        trace = {
+            'stream': self.stream,
+            'timestamp': self.timestamp,
+            'received_at': self.received_at,
+            'duration': time.monotonic() - self._start,
+            'spans': [{'stage': s, 'start': start, 'duration': d} for s, start, d in self.spans],
+        }
+        if self.timestamp:
+            trace['capture_delay'] = self.received_at - self.timestamp / 1e9
+        return trace
+
+    def finish(self):
+        logger.info(json.dumps(self.to_dict()))
+
+class Tracer(object):
+    """
+    Starts a trace for a `sample_rate` fraction of the frames
+    """
+
+    def __init__(self, sample_rate=0.):
+        self.sample_rate = sample_rate
+
+    def start(self, stream, timestamp=0):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return Trace(stream, timestamp)
+        return None
+
+def record_frame_latency(timestamp):
+    """
+    Observe the latency from the capture of a frame, whose timestamp is in nanoseconds
+    since the epoch. It relies on the clocks of the data source and of the runtime being in sync.
+    """
+    if timestamp:
+        FRAME_LATENCY.observe(max(time.time() - timestamp / 1e9, 0.))
+
+# --------------------------------------------------------------------------- #
+
+class StageTimer(object):
+    def __init__(self, stage, trace):
+        self._stage = stage
+        self._trace = trace
+
+    def __enter__(self):
+        self._start = time.monotonic()
+
+    def __exit__(self, *args):
+        end = time.monotonic()
+        self._stage.latency.observe(end - self._start)
+        if self._trace is not None:
+            self._trace.add_span(self._stage.name, self._start, end)
+
+class Stage(object):
+    """
+    A stage of the pipeline, timed in its latency histogram and in the trace of the frame if any
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = metrics.STAGE_LATENCY.labels(name)
+
+    def time(self, trace=None):
+        return StageTimer(self, trace)
+
+    def observe(self, start, end, trace=None):
+        self.latency.observe(end - start)
+        if trace is not None:
+            trace.add_span(self.name, start, end)
@@ -0,0 +1,108 @@
+import copy
+import logging
+import numpy as np
+
+from serializer import InferenceResult
+
+logger = logging.getLogger(__name__)
+
+BBOX_KEYS = ('xmin', 'ymin', 'xmax', 'ymax')
+
+# --------------------------------------------------------------------------- #
+
+def get_bboxes(predictions):
+    return np.array([[p['roi']['bbox'][k] for k in BBOX_KEYS] for p in predictions], dtype=np.float64).reshape((-1, 4))
+
+def iou_matrix(boxes1, boxes2):
+    """
+    Intersection over union of each box of `boxes1` with each box of `boxes2`, as a (N1, N2) matrix
+    """
+    a, b = boxes1[:, None, :], boxes2[None, :, :]
+    w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = w * h
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.)
+
+def match_predictions(previous, current, min_iou):
+    """
+    Greedily match the predictions of two results by decreasing IoU of their boxes, among those of the same label.
+    Return the list of (previous index, current index) pairs.
+    """
+    if not previous or not current:
+        return []
+    ious = iou_matrix(get_bboxes(previous), get_bboxes(current))
+    same_label = np.array([[p.get('label_id') == c.get('label_id') for c in current] for p in previous])
+    ious[~same_label] = 0.
+
+    matches = []
+    previous_matched, current_matched = set(), set()
+    for i, j in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+        if ious[i, j] < min_iou:
+            break
+        if i not in previous_matched and j not in current_matched:
+            previous_matched.add(i)
+            current_matched.add(j)
+            matches.append((i, j))
+    return matches
+
+# --------------------------------------------------------------------------- #
+
+class Tracks(object):
+    """
+    Constant-velocity tracks of the boxes of an inference result, from the boxes of the
+    previous inference result they overlap the most with. `predict` moves the boxes to
+    a later frame of the stream, up to as many frames as there were between the two results.
+    Boxes without a match in the previous result, or all of them if there is none, stay still.
+    """
+
+    def __init__(self, current, current_index, previous=None, previous_index=None, min_iou=0.3):
+        self.current = current
+        self.current_index = current_index
+        self.max_frames = 0
+        self._velocities = []  # per output, (N, 4) array of box moves per frame
+
+        for n, output in enumerate(current['outputs']):
+            predictions = self.get_predictions(output)
+            velocities = np.zeros((len(predictions), 4))
+            if previous is not None and previous_index < current_index and n < len(previous['outputs']):
+                previous_predictions = self.get_predictions(previous['outputs'][n])
+                frames = current_index - previous_index
+                for i, j in match_predictions(previous_predictions, predictions, min_iou):
+                    velocities[j] = (get_bboxes(predictions[j:j + 1])[0] - get_bboxes(previous_predictions[i:i + 1])[0]) / frames
+                self.max_frames = frames
+            self._velocities.append(velocities)
+
+    @staticmethod
+    def get_predictions(output):
+        labels = output.get('labels') or {}
+        return [p for p in labels.get('predicted', []) if p.get('roi') is not None]
+
+    @property
+    def moving(self):
+        return any(v.any() for v in self._velocities)
+
+    def predict(self, index):
+        """
+        Return the result with the boxes at frame `index`, the current result itself if they do not move
+        """
+        frames = min(index - self.current_index, self.max_frames)
+        if frames <= 0 or not self.moving:
+            return self.current
+
+        outputs = copy.deepcopy(self.current['outputs'])
+        for output, velocities in zip(outputs, self._velocities):
+            predictions = self.get_predictions(output)
+            if not predictions:
+                continue
+            bboxes = np.clip(get_bboxes(predictions) + velocities * frames, 0, 1)
+            for prediction, bbox in zip(predictions, bboxes.tolist()):
+                prediction['roi']['bbox'].update(zip(BBOX_KEYS, bbox))
+
+        # The protobuf result is updated with the boxes when serialized: do not share it
+        proto_result = getattr(self.current, 'proto_result', None)
+        if proto_result is not None:
+            proto_result = copy.deepcopy(proto_result)
+        return InferenceResult(outputs, proto_result)
@@ -1,16 +1,67 @@
 import io
+from collections import namedtuple
+from functools import lru_cache
 import numpy as np
 from PIL import Image, ImageOps
 
-def crop_and_dump(image, aspect_ratio):
-    image, change_of_basis_matrix = crop(image, aspect_ratio)
+def load(image):
+    image = Image.open(io.BytesIO(image))
+    image.load()
+    return image
+
+def dump(image):
     with io.BytesIO() as buff:
         image.save(buff, format="JPEG")
-        return buff.getvalue(), change_of_basis_matrix
+        return buff.getvalue()
+
+def get_downscaled_size(size, max_size):
+    """
+    Return the size scaled down, keeping the aspect ratio, so that its largest side is at most `max_size`
+    """
+    W, H = size
+    scale = max_size / max(W, H)
+    if scale >= 1:
+        return size
+    return max(1, int(round(W * scale))), max(1, int(round(H * scale)))
+
+def resize(image, size):
+    """
+    Resize a PIL image or an array of pixels
+    """
+    if isinstance(image, np.ndarray):
+        return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR))
+    return image.resize(size, Image.BILINEAR)
+
+def get_thumbnail(image, size):
+    """
+    Return a grayscale thumbnail of `size` as an array of shape (height, width).
+    Encoded images are decoded at a reduced scale, the gray level of arrays of pixels
+    is the mean of their channels whatever their order.
+    """
+    if isinstance(image, (bytes, memoryview)):
+        image = Image.open(io.BytesIO(image))
+        image.draft('L', size)
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3:
+            image = image.mean(axis=2).astype(np.uint8)
+        image = Image.fromarray(image)
+    return np.asarray(image.convert('L').resize(size, Image.BILINEAR))
 
-def crop(image, aspect_ratio):
-    image = Image.open(io.BytesIO(image))
-    W, H = image.size
+def crop_and_dump(image, aspect_ratio):
+    image, change_of_basis_matrix = crop(image, aspect_ratio)
+    return dump(image), change_of_basis_matrix
+
+# Crop geometry: the crop box (xmin, ymin, xmax, ymax) in the input image, the mirror
+# padding (before, after) added along `axis` and the normalized change of basis matrix
+CropGeometry = namedtuple('CropGeometry', ['box', 'pad', 'axis', 'change_of_basis_matrix'])
+
+@lru_cache(maxsize=32)
+def get_crop_geometry(W, H, aspect_ratio):
+    """
+    Compute the geometry of the crop of a W x H image to `aspect_ratio`.
+    A stream almost never changes resolution so results are cached,
+    hits and misses are given by `get_crop_geometry.cache_info()`.
+    """
     current_aspect_ratio = W / H
 
     # w, h are solutions of:
@@ -21,9 +72,11 @@ def crop(image, aspect_ratio):
     w = int(round(h * aspect_ratio))
 
     if current_aspect_ratio < aspect_ratio:
-        image, change_of_basis_matrix = crop_V_pad_H(image, w, h)
+        box, pad, change_of_basis_matrix = crop_V_pad_H_geometry(W, H, w, h)
+        axis = 1
     else:
-        image, change_of_basis_matrix = crop_H_pad_V(image, w, h)
+        box, pad, change_of_basis_matrix = crop_H_pad_V_geometry(W, H, w, h)
+        axis = 0
 
     denorm_old_basis = np.array([
         [W, 0, 0],
@@ -36,11 +89,77 @@ def crop(image, aspect_ratio):
         [0,       0,     1]
     ])
     change_of_basis_matrix = np.dot(np.dot(norm_new_basis, change_of_basis_matrix), denorm_old_basis)
+    change_of_basis_matrix.flags.writeable = False  # shared by all the frames of the same size
 
-    return image, change_of_basis_matrix
+    return CropGeometry(box, pad, axis, change_of_basis_matrix)
 
-def crop_V_pad_H(image, w, h):
-    W, H = image.size
+def crop(image, aspect_ratio):
+    # Accept encoded images, decoded images and arrays of pixels
+    if isinstance(image, (bytes, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    W, H = get_size(image)
+    geometry = get_crop_geometry(W, H, aspect_ratio)
+    image = crop_and_pad(image, geometry.box, geometry.pad, geometry.axis)
+    return image, geometry.change_of_basis_matrix
+
+def get_size(image):
+    """
+    Return (width, height) of a PIL image or an array of pixels
+    """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+def mirror_pad(pixels, before, after, axis):
+    """
+    Pad an array of pixels along `axis` with the mirror of its borders.
+    Like the PIL implementation, mirrors larger than the image are completed with black.
+    """
+    size = pixels.shape[axis]
+    shape = list(pixels.shape)
+    shape[axis] = before + size + after
+    new_pixels = np.empty(shape, dtype=pixels.dtype)
+
+    # Fill the result through views where `axis` comes first
+    src = np.moveaxis(pixels, axis, 0)
+    dst = np.moveaxis(new_pixels, axis, 0)
+    n = min(before, size)
+    dst[:before - n] = 0
+    dst[before - n:before] = src[:n][::-1]
+    dst[before:before + size] = src
+    n = min(after, size)
+    dst[before + size:before + size + n] = src[size - n:][::-1]
+    dst[before + size + n:] = 0
+    return new_pixels
+
+def crop_and_pad(image, box, pad, axis):
+    """
+    Crop `box` out of the image then pad it along `axis` (1: horizontally, 0: vertically)
+    with the mirror of its borders
+    """
+    xmin, ymin, xmax, ymax = box
+    before, after = pad
+
+    if isinstance(image, np.ndarray):
+        return mirror_pad(image[ymin:ymax, xmin:xmax], before, after, axis)
+
+    # A crop larger than the image allocates the result once, borders are black
+    image = image if image.mode == 'RGB' else image.convert('RGB')
+    if axis == 1:
+        new_image = image.crop((xmin - before, ymin, xmax + after, ymax))
+        if before > 0:
+            new_image.paste(ImageOps.mirror(image.crop((xmin, ymin, xmin + before, ymax))), (0, 0))
+        if after > 0:
+            new_image.paste(ImageOps.mirror(image.crop((xmax - after, ymin, xmax, ymax))), (before + xmax - xmin, 0))
+    else:
+        new_image = image.crop((xmin, ymin - before, xmax, ymax + after))
+        if before > 0:
+            new_image.paste(ImageOps.flip(image.crop((xmin, ymin, xmax, ymin + before))), (0, 0))
+        if after > 0:
+            new_image.paste(ImageOps.flip(image.crop((xmin, ymax - after, xmax, ymax))), (0, before + ymax - ymin))
+    return new_image
+
+def crop_V_pad_H_geometry(W, H, w, h):
     ymin = int((H - h) / 2)
     ymax = ymin + h
     assert ymin >= 0
@@ -51,14 +170,6 @@ def crop_V_pad_H(image, w, h):
     assert offset >= 0
     assert rest >= 0
 
-    new_image = Image.new('RGB', (w, h))
-    image = image.crop((0, ymin, W, ymax))
-    assert (W, h) == image.size
-
-    new_image.paste(ImageOps.mirror(image.crop((0, 0, offset, h))), (0, 0))
-    new_image.paste(image, (offset, 0))
-    new_image.paste(ImageOps.mirror(image.crop((W - rest, 0, W, h))), (offset + W, 0))
-
     # Compute new coordinate system for bboxes
     change_of_basis_matrix = np.array([
         [1, 0, offset],
@@ -66,10 +177,9 @@ def crop_V_pad_H(image, w, h):
         [0, 0,      1]
     ])
 
-    return new_image, change_of_basis_matrix
+    return (0, ymin, W, ymax), (offset, rest), change_of_basis_matrix
 
-def crop_H_pad_V(image, w, h):
-    W, H = image.size
+def crop_H_pad_V_geometry(W, H, w, h):
     xmin = int((W - w) / 2)
     xmax = xmin + w
     assert xmin >= 0
@@ -80,14 +190,6 @@ def crop_H_pad_V(image, w, h):
     assert offset >= 0
     assert rest >= 0
 
-    new_image = Image.new('RGB', (w, h))
-    image = image.crop((xmin, 0, xmax, H))
-    assert (w, H) == image.size
-
-    new_image.paste(ImageOps.flip(image.crop((0, 0, w, offset))), (0, 0))
-    new_image.paste(image, (0, offset))
-    new_image.paste(ImageOps.flip(image.crop((0, H - rest, w, H))), (0, offset + H))
-
     # Compute new coordinate system for bboxes
     change_of_basis_matrix = np.array([
         [1, 0,  -xmin],
@@ -95,7 +197,17 @@ def crop_H_pad_V(image, w, h):
         [0, 0,      1]
     ])
 
-    return new_image, change_of_basis_matrix
+    return (xmin, 0, xmax, H), (offset, rest), change_of_basis_matrix
+
+def crop_V_pad_H(image, w, h):
+    W, H = get_size(image)
+    box, pad, change_of_basis_matrix = crop_V_pad_H_geometry(W, H, w, h)
+    return crop_and_pad(image, box, pad, axis=1), change_of_basis_matrix
+
+def crop_H_pad_V(image, w, h):
+    W, H = get_size(image)
+    box, pad, change_of_basis_matrix = crop_H_pad_V_geometry(W, H, w, h)
+    return crop_and_pad(image, box, pad, axis=0), change_of_basis_matrix
 
 def normalize_roi(roi, change_of_basis_matrix):
     def clip_coord(c):
@@ -109,3 +221,21 @@ def normalize_roi(roi, change_of_basis_matrix):
     bbox = roi['bbox']
     bbox['xmin'], bbox['ymin'] = normalize_point(bbox['xmin'], bbox['ymin'])
     bbox['xmax'], bbox['ymax'] = normalize_point(bbox['xmax'], bbox['ymax'])
+
+def normalize_rois(rois, change_of_basis_matrix):
+    """
+    Same as `normalize_roi` for many ROIs at once: the corners of all bounding boxes
+    go through the change of basis and the clipping as a single (2N, 3) matrix.
+    """
+    bboxes = [roi['bbox'] for roi in rois]
+    if not bboxes:
+        return
+    points = np.array([
+        [bbox[x], bbox[y], 1]
+        for bbox in bboxes
+        for x, y in (('xmin', 'ymin'), ('xmax', 'ymax'))
+    ], dtype=np.float64)
+    points = np.dot(points, change_of_basis_matrix.T)
+    coords = np.clip(points[:, :2] / points[:, 2:], 0, 1).reshape((-1, 4)).tolist()
+    for bbox, (xmin, ymin, xmax, ymax) in zip(bboxes, coords):
+        bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax'] = xmin, ymin, xmax, ymax
@@ -0,0 +1,84 @@
+"""
+Minimal reading and writing of the protobuf wire format, to handle the large bytes
+fields of messages as slices of their buffer rather than through copies
+"""
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# --------------------------------------------------------------------------- #
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+def decode_varint(data, pos):
+    """
+    Return the varint at `pos` in `data` and the position after it
+    """
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise Exception('Truncated protobuf message')
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def encode_field_header(number, length):
+    """
+    Tag and length of a length-delimited field
+    """
+    return encode_varint(number << 3 | LENGTH_DELIMITED) + encode_varint(length)
+
+def iter_fields(data):
+    """
+    Yield the (number, start, value start, end) of the fields of a serialized message,
+    the field spanning data[start:end] and its value data[value start:end]
+    """
+    pos = 0
+    while pos < len(data):
+        start = pos
+        tag, pos = decode_varint(data, pos)
+        number, wire_type = tag >> 3, tag & 7
+        if wire_type == VARINT:
+            value_start = pos
+            _, pos = decode_varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, value_start = decode_varint(data, pos)
+            pos = value_start + length
+        elif wire_type == FIXED64:
+            value_start, pos = pos, pos + 8
+        elif wire_type == FIXED32:
+            value_start, pos = pos, pos + 4
+        else:
+            raise Exception('Unsupported protobuf wire type {}'.format(wire_type))
+        if pos > len(data):
+            raise Exception('Truncated protobuf message')
+        yield number, start, value_start, pos
+
+def split_field(data, number):
+    """
+    Return the value of the length-delimited field `number` of a serialized message as
+    a memoryview of `data`, None if it is not set, and the other fields serialized
+    """
+    data = memoryview(data)
+    value = None
+    others = []
+    for field_number, start, value_start, end in iter_fields(data):
+        if field_number == number:
+            value = data[value_start:end]  # the last one wins
+        else:
+            others.append(data[start:end])
+    return value, b''.join(others)
@@ -2,12 +2,14 @@ import pytest
 import os
 import sys
 import io
+import numpy as np
 from PIL import Image
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
 
 import draw
 import utils
+import reference_crop
 
 tagging_payload = {
     "outputs": [{
@@ -82,6 +84,103 @@ def test_display_draw_detect_result(kwargs):
     img = Image.open(io.BytesIO(payload))
     img.save("result_detect.jpg")
 
+@pytest.mark.parametrize(
+    'inference_result', [tagging_payload, detection_payload]
+)
+def test_overlay_renderer(inference_result):
+    img = utils.load(read_test_image('screenshot.jpg'))
+    draw.FONT = None
+    expected = np.asarray(draw.draw_predictions_on_image(img.copy(), inference_result, **TEST_KWARGS), dtype=int)
+
+    draw.FONT = None
+    renderer = draw.OverlayRenderer(**TEST_KWARGS)
+    result = renderer.draw(img.copy(), inference_result)
+    overlay = renderer._cache[2]
+    renderer.draw(img.copy(), inference_result)
+    assert renderer._cache[2] is overlay
+
+    # Only anti-aliased text edges may be blended differently
+    diff = np.abs(np.asarray(result, dtype=int) - expected)
+    assert diff.max() <= 16
+    assert (diff > 2).mean() < 0.01
+
+def test_overlay_patches():
+    alpha = np.zeros((100, 200), dtype=np.uint8)
+    alpha[10, 5] = alpha[10, 40] = alpha[10, 150] = alpha[99, 199] = 255
+    assert draw.get_patches(alpha, 32) == [(0, 0, 64, 32), (128, 0, 160, 32), (192, 96, 200, 100)]
+    assert draw.get_patches(np.zeros((100, 200), dtype=np.uint8), 32) == []
+
+def test_overlay_spread_boxes(monkeypatch):
+    from fakes import make_detection_payload  # fakes imports the payloads of this module
+    img = utils.load(read_test_image('screenshot.jpg'))
+    payload = make_detection_payload(10, max_size=0.1)
+    draw.FONT = None
+    overlay = draw.render_overlay(payload, img.size, **TEST_KWARGS)
+    assert len(overlay.patches) > 1
+
+    # The patches blend the same pixels as the whole layer
+    monkeypatch.setattr(draw, 'OVERLAY_TILE_SIZE', max(img.size))
+    draw.FONT = None
+    whole = draw.render_overlay(payload, img.size, **TEST_KWARGS)
+    assert len(whole.patches) == 1
+    assert (np.asarray(overlay.apply(img.copy())) == np.asarray(whole.apply(img.copy()))).all()
+
+@pytest.fixture
+def cv2_backend():
+    pytest.importorskip('cv2')
+    draw.set_backend('cv2')
+    yield draw.BACKEND
+    draw.set_backend('pil')
+
+@pytest.mark.parametrize(
+    'inference_result', [tagging_payload, detection_payload]
+)
+def test_cv2_backend_same_layout(cv2_backend, inference_result):
+    data = read_test_image('screenshot.jpg')
+    img = cv2_backend.decode_img(data)
+    result = draw.draw_predictions_on_image(img.copy(), inference_result, **TEST_KWARGS)
+    changed = (result != img).any(axis=2)
+
+    draw.set_backend('pil')
+    pil_img = utils.load(data)
+    pil_result = draw.draw_predictions_on_image(pil_img.copy(), inference_result, **TEST_KWARGS)
+    pil_changed = (np.asarray(pil_result) != np.asarray(pil_img)).any(axis=2)
+
+    # Both backends draw on the same area
+    assert (changed & pil_changed).sum() / (changed | pil_changed).sum() > 0.6
+
+@pytest.mark.parametrize(
+    'inference_result', [tagging_payload, detection_payload]
+)
+def test_cv2_backend_overlay(cv2_backend, inference_result):
+    img = cv2_backend.decode_img(read_test_image('screenshot.jpg'))
+    expected = draw.draw_predictions_on_image(img.copy(), inference_result, **TEST_KWARGS).astype(int)
+    result = draw.OverlayRenderer(**TEST_KWARGS).draw(img.copy(), inference_result)
+
+    # The anti-aliased text is opaque on the overlay too
+    diff = np.abs(result.astype(int) - expected)
+    assert diff.max() <= 16
+    assert (diff > 2).mean() < 0.01
+
+    # Large boxes are cheaper to draw again than to blend
+    from fakes import make_detection_payload
+    assert draw.render_overlay(make_detection_payload(10), (3840, 2160), **TEST_KWARGS).patches is None
+
+    payload = draw.draw_predictions(read_test_image('screenshot.jpg'), detection_payload, **TEST_KWARGS)
+    assert Image.open(io.BytesIO(payload)).size == (576, 1024)
+
+def test_cv2_backend_concurrent_draws(cv2_backend):
+    from concurrent.futures import ThreadPoolExecutor
+    img = cv2_backend.decode_img(read_test_image('screenshot.jpg'))
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(50):
+            # The first draws of the pool all find the font unset
+            draw.FONT = None
+            futures = [pool.submit(draw.draw_predictions_on_image, img.copy(), detection_payload, **TEST_KWARGS)
+                       for _ in range(8)]
+            for future in futures:
+                future.result()
+
 def test_crop_h():
     img = read_test_image('dog.jpg')
     aspect_ratio = 4 / 3
@@ -98,6 +197,37 @@ def test_crop_v():
     assert w / h == pytest.approx(aspect_ratio)
     img.save("result_crop_v.jpg")
 
+@pytest.mark.parametrize(
+    'aspect_ratio', [4 / 3, 3 / 4, 16 / 9, 1, 1 / 4]
+)
+def test_crop_same_as_pil(aspect_ratio):
+    img = utils.load(read_test_image('screenshot.jpg'))
+    W, H = img.size
+    h = int(round((W + H) / (aspect_ratio + 1)))
+    w = int(round(h * aspect_ratio))
+    if W / H < aspect_ratio:
+        crop_pad, pil_crop_pad = utils.crop_V_pad_H, reference_crop.pil_crop_V_pad_H
+    else:
+        crop_pad, pil_crop_pad = utils.crop_H_pad_V, reference_crop.pil_crop_H_pad_V
+    pil_img, pil_change_of_basis_matrix = pil_crop_pad(img, w, h)
+    for image in [img, np.asarray(img)]:
+        new_img, change_of_basis_matrix = crop_pad(image, w, h)
+        if isinstance(new_img, np.ndarray):
+            new_img = Image.fromarray(new_img)
+        assert new_img.size == pil_img.size
+        assert new_img.tobytes() == pil_img.tobytes()
+        assert (change_of_basis_matrix == pil_change_of_basis_matrix).all()
+
+def test_crop_geometry_cache():
+    img = utils.load(read_test_image('screenshot.jpg'))
+    utils.get_crop_geometry.cache_clear()
+    _, change_of_basis_matrix = utils.crop(img, 4 / 3)
+    _, cached_change_of_basis_matrix = utils.crop(img, 4 / 3)
+    assert cached_change_of_basis_matrix is change_of_basis_matrix
+    utils.crop(img, 3 / 4)
+    cache_info = utils.get_crop_geometry.cache_info()
+    assert (cache_info.hits, cache_info.misses) == (1, 2)
+
 def test_crop_change_coords():
     def make_roi(margin=0):
         return {
@@ -140,6 +270,32 @@ def test_crop_change_coords():
         'ymax': pytest.approx(0.74795539),
     }
 
+@pytest.mark.parametrize(
+    'aspect_ratio', [4 / 3, 3 / 4, 16 / 9]
+)
+def test_normalize_rois_same_as_normalize_roi(aspect_ratio):
+    _, change_of_basis_matrix = utils.crop(read_test_image('screenshot.jpg'), aspect_ratio)
+    rng = np.random.RandomState(0)
+    rois = [{'bbox': dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], rng.uniform(-0.1, 1.1, 4)))} for _ in range(500)]
+    batch_rois = [{'bbox': dict(roi['bbox'])} for roi in rois]
+
+    utils.normalize_rois(batch_rois, change_of_basis_matrix)
+    for roi, batch_roi in zip(rois, batch_rois):
+        utils.normalize_roi(roi, change_of_basis_matrix)
+        for key, value in roi['bbox'].items():
+            assert batch_roi['bbox'][key] == float(np.asarray(value).ravel()[0])
+
+def test_crop_change_coords_downscaled():
+    img = utils.load(read_test_image('screenshot.jpg'))
+    small_img = img.resize(utils.get_downscaled_size(img.size, 256))
+
+    roi = {'bbox': {'xmin': 0.2, 'ymin': 0.3, 'xmax': 0.7, 'ymax': 0.6}}
+    small_roi = {'bbox': dict(roi['bbox'])}
+    utils.normalize_roi(roi, utils.crop(img, 4 / 3)[1])
+    utils.normalize_roi(small_roi, utils.crop(small_img, 4 / 3)[1])
+    for key, value in roi['bbox'].items():
+        assert small_roi['bbox'][key] == pytest.approx(value, abs=1e-2)
+
 
 if __name__ == '__main__':
     kwargs = {
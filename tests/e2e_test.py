@@ -68,7 +68,7 @@ def run_nats_loop(status, topic_suffix, message_handler):
 def test_draw_on_image():
     status = Status()
 
-    async def message_handler(payload):
+    async def message_handler(payload, topic, source, received_at):
         nonlocal status
         try:
             img = Image.open(io.BytesIO(payload))
@@ -83,10 +83,10 @@ def test_draw_on_image():
 def test_draw_on_json():
     status = Status()
 
-    async def message_handler(payload):
+    async def message_handler(payload, topic, source, received_at):
         nonlocal status
         try:
-            json.loads(payload)
+            json.loads(bytes(payload))
         except Exception as e:  # happens if no image can be decoded
             status.signal_exception(e)
             return
@@ -105,7 +105,7 @@ def run_benchmark(expected_fps=None):
     else:
         topic_suffix = 'IMAGE'
 
-    async def message_handler(payload):
+    async def message_handler(payload, topic, source, received_at):
         nonlocal N, counter, first_received, last_received
         last_received = time.time()
         if first_received is None:
@@ -0,0 +1,233 @@
+"""
+In-process stand-ins for the neural worker and the NATS broker, to run the whole
+runtime, e.g. for load tests, without RabbitMQ, a neural worker or a NATS server
+"""
+import copy
+import time
+import heapq
+import random
+import threading
+import asyncio
+import itertools
+from collections import defaultdict
+
+from google.protobuf.json_format import ParseDict
+from deepomatic.rpc.response import Response, AMQPTimeout
+from deepomatic.rpc.buffers.protobuf.nn.Result_pb2 import Result
+
+from draw_test import detection_payload
+
+# --------------------------------------------------------------------------- #
+
+def make_detection_payload(n_boxes, seed=0, max_size=1.):
+    """
+    A detection result with `n_boxes` random boxes, the same ones for a given seed,
+    at most `max_size` wide and high relatively to the image
+    """
+    rng = random.Random(seed)
+    template = detection_payload['outputs'][0]['labels']['predicted'][0]
+    predicted = []
+    for i in range(n_boxes):
+        prediction = copy.deepcopy(template)
+        x, y = rng.uniform(0, 0.9), rng.uniform(0, 0.9)
+        w, h = rng.uniform(0.02, min(max_size, 1 - x)), rng.uniform(0.02, min(max_size, 1 - y))
+        prediction['roi']['region_id'] = i + 1
+        prediction['roi']['bbox'] = {'xmin': x, 'ymin': y, 'xmax': x + w, 'ymax': y + h}
+        prediction['score'] = rng.uniform(0.35, 1.)
+        predicted.append(prediction)
+    return {'outputs': [{'labels': {'predicted': predicted, 'discarded': []}}]}
+
+def make_proto_result(payload):
+    """
+    The protobuf result of the neural worker for a result as returned by Deepomatic API v0.7
+    """
+    result = Result()
+    ParseDict({'outputs': payload['outputs']}, result.v07_recognition, ignore_unknown_fields=True)
+    return result
+
+# --------------------------------------------------------------------------- #
+
+class FakeQueue(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeAMQPMessage(object):
+    def __init__(self, body, correlation_id):
+        self.body = body
+        self.properties = {'correlation_id': correlation_id}
+
+class FakeWorker(object):
+    """
+    Plays the deepomatic RPC client and consumer of a neural worker: each command is
+    answered after `latency` seconds, plus a uniform jitter in [-jitter, jitter], the
+    worker processing at most `concurrency` commands at once. Answers are the given
+    `payloads` in turn, by default detections of `n_boxes` random boxes.
+    """
+
+    def __init__(self, latency=0.02, jitter=0., concurrency=1, payloads=None, n_boxes=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        if payloads is None:
+            payloads = [make_detection_payload(n_boxes, seed=seed + i) for i in range(8)]
+        self._bodies = itertools.cycle([make_proto_result(p).SerializeToString() for p in payloads])
+        self._ids = itertools.count()
+        self._free_at = [0.] * concurrency  # time at which each processing slot is free
+        self._responses = []  # heap of (ready time, correlation_id, body)
+        self._lock = threading.Lock()  # Responses are consumed from another thread
+
+        self.commands = 0
+
+    # Client
+
+    def new_queue(self, name):
+        return FakeQueue(name)
+
+    def new_consuming_queue(self):
+        return FakeQueue('response_queue'), self
+
+    def send_binary(self, binary_data, command_queue_name, **properties):
+        correlation_id = 'fake-{}'.format(next(self._ids))
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, heapq.heappop(self._free_at))
+            done = start + max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0.)
+            heapq.heappush(self._free_at, done)
+            heapq.heappush(self._responses, (done, correlation_id, next(self._bodies)))
+        self.commands += 1
+        return correlation_id
+
+    # Consumer
+
+    def _pop_ready(self, correlation_id):
+        with self._lock:
+            return self._pop_ready_locked(correlation_id)
+
+    def _pop_ready_locked(self, correlation_id):
+        now = time.monotonic()
+        if correlation_id is None:
+            if self._responses and self._responses[0][0] <= now:
+                _, id_, body = heapq.heappop(self._responses)
+                return Response(FakeAMQPMessage(body, id_))
+            return None
+        for i, (ready_at, id_, body) in enumerate(self._responses):
+            if ready_at <= now and id_ == correlation_id:
+                self._responses.pop(i)
+                heapq.heapify(self._responses)
+                return Response(FakeAMQPMessage(body, id_))
+        return None
+
+    def get(self, correlation_id=None, timeout=float('inf'), drain_events_timeout=0.005):
+        """
+        Same as the consumer of deepomatic RPC: `timeout=None` drains the connection once,
+        waiting `drain_events_timeout` seconds at most, otherwise AMQPTimeout is raised if
+        no response is ready in time
+        """
+        response = self._pop_ready(correlation_id)
+        deadline = time.monotonic() + (drain_events_timeout if timeout is None else timeout)
+        while response is None:
+            if time.monotonic() >= deadline:
+                if timeout is None:
+                    return None
+                raise AMQPTimeout(timeout)
+            time.sleep(drain_events_timeout)
+            response = self._pop_ready(correlation_id)
+        return response
+
+# --------------------------------------------------------------------------- #
+
+class FakeNATSMessage(object):
+    def __init__(self, subject, data, reply=''):
+        self.subject = subject
+        self.data = data
+        self.reply = reply
+
+class Subscription(object):
+    def __init__(self, subject, queue, cb):
+        self.subject = subject
+        self.queue = queue
+        self.cb = cb
+        self.messages = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.deliver())
+
+    async def deliver(self):
+        # As with the NATS client, a subscription handles its messages one at a time
+        while True:
+            msg = await self.messages.get()
+            await self.cb(msg)
+
+class InMemoryNATS(object):
+    """
+    A NATS broker in the event loop, for the clients returned by `client()`.
+    Subjects are matched exactly and each message of a queue group goes to one of its subscriptions in turn.
+    """
+
+    def __init__(self):
+        self._sids = itertools.count(1)
+        self._subscriptions = {}  # sid -> subscription
+        self._next_in_group = defaultdict(int)  # (subject, queue) -> counter
+
+        self.published = 0
+
+    def client(self):
+        return InMemoryNATSClient(self)
+
+    def subscribe(self, subject, queue, cb):
+        sid = next(self._sids)
+        self._subscriptions[sid] = Subscription(subject, queue, cb)
+        return sid
+
+    def unsubscribe(self, sid):
+        subscription = self._subscriptions.pop(sid, None)
+        if subscription is not None:
+            subscription.task.cancel()
+
+    def publish(self, subject, data):
+        self.published += 1
+        groups = defaultdict(list)
+        for subscription in self._subscriptions.values():
+            if subscription.subject != subject:
+                continue
+            if subscription.queue:
+                groups[subscription.queue].append(subscription)
+            else:
+                subscription.messages.put_nowait(FakeNATSMessage(subject, data))
+        for queue, subscriptions in groups.items():
+            counter = self._next_in_group[subject, queue]
+            self._next_in_group[subject, queue] += 1
+            subscriptions[counter % len(subscriptions)].messages.put_nowait(FakeNATSMessage(subject, data))
+
+class InMemoryNATSClient(object):
+    """
+    The subset of the asyncio NATS client used by the runtime
+    """
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._sids = set()
+        self.is_connected = False
+
+    async def connect(self, servers=None, loop=None, **kwargs):
+        self.is_connected = True
+
+    async def subscribe(self, subject, queue='', cb=None, **kwargs):
+        sid = self._broker.subscribe(subject, queue, cb)
+        self._sids.add(sid)
+        return sid
+
+    async def unsubscribe(self, sid, max_msgs=0):
+        self._broker.unsubscribe(sid)
+        self._sids.discard(sid)
+
+    async def publish(self, subject, payload):
+        if not self.is_connected:
+            raise Exception('Not connected')
+        self._broker.publish(subject, payload)
+
+    def drain(self):
+        pass
+
+    async def close(self):
+        for sid in list(self._sids):
+            await self.unsubscribe(sid)
+        self.is_connected = False
@@ -0,0 +1,74 @@
+import os
+import sys
+import io
+import pytest
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+import draw
+from frame import Frame, prepare_inference_image, prepare_inference_data
+from draw_test import read_test_image, detection_payload, TEST_KWARGS
+
+# --------------------------------------------------------------------------- #
+
+def test_frame_not_decoded_if_not_needed():
+    data = read_test_image('dog.jpg')
+    frame = Frame(data)
+    assert frame.to_bytes() is data
+    assert not frame.decoded
+
+def test_frame_decoded_once():
+    frame = Frame(read_test_image('dog.jpg'))
+    image = frame.image
+    assert frame.decoded
+    assert frame.image is image
+    assert frame.size == image.size
+
+def test_frame_encoded_after_draw():
+    data = read_test_image('screenshot.jpg')
+    frame = Frame(data)
+    draw.FONT = None
+    frame.image = draw.draw_predictions_on_image(frame.image, detection_payload, **TEST_KWARGS)
+    payload = frame.to_bytes()
+    assert payload != data
+    assert frame.to_bytes() is payload
+
+    draw.FONT = None
+    assert payload == draw.draw_predictions(data, detection_payload, **TEST_KWARGS)
+
+def test_frame_copy_drawn():
+    data = read_test_image('screenshot.jpg')
+    frame = Frame(data)
+    pixels = frame.image.tobytes()
+    copy = frame.copy()
+    copy.image = draw.draw_predictions_on_image(copy.image, detection_payload, **TEST_KWARGS)
+    assert copy.to_bytes() != data
+    assert frame.image.tobytes() == pixels
+    assert frame.to_bytes() is data
+
+@pytest.mark.parametrize(
+    'draft', [False, True]
+)
+def test_frame_resized(draft):
+    data = read_test_image('screenshot.jpg')
+    frame = Frame(data)
+    small_frame = frame.resized(256, draft=draft)
+    assert small_frame.size == (144, 256)
+    assert frame.decoded != draft
+    assert Image.open(io.BytesIO(small_frame.to_bytes())).size == (144, 256)
+
+    assert frame.resized(2000) is frame
+
+def test_prepare_inference_image_as_is():
+    data = read_test_image('dog.jpg')
+    image, change_of_basis_matrix = prepare_inference_image(Frame(data))
+    assert image is data
+    assert change_of_basis_matrix is None
+
+def test_prepare_inference_data():
+    data = read_test_image('screenshot.jpg')
+    image, expected_matrix = prepare_inference_image(Frame(data), 300, 1.)
+    other_image, change_of_basis_matrix = prepare_inference_data(data, 300, 1.)
+    assert Image.open(io.BytesIO(other_image)).size == Image.open(io.BytesIO(image)).size
+    assert (change_of_basis_matrix == expected_matrix).all()
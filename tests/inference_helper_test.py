@@ -0,0 +1,235 @@
+import asyncio
+import os
+import sys
+import time
+import pytest
+import itertools
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from deepomatic.rpc import v07_ImageInput
+from deepomatic.rpc.helpers.proto import create_serialized_command
+from deepomatic.rpc.helpers.v07_proto import create_images_input_mix, create_workflow_command_mix
+from deepomatic.rpc.buffers.protobuf.nn.Message_pb2 import Message
+
+from inference_helper import InferenceHelper, serialize_image_command
+
+# --------------------------------------------------------------------------- #
+
+class FakeMessage(object):
+    def __init__(self, correlation_id):
+        self.properties = {'correlation_id': correlation_id}
+
+class FakeResponse(object):
+    def __init__(self, correlation_id):
+        self.msg = FakeMessage(correlation_id)
+
+class FakeQueue(object):
+    name = 'response_queue'
+
+class FakeAMQP(object):
+    """
+    Plays the role of both the RPC client and the consumer: commands are answered
+    in reverse order once `answer()` is called.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count()
+        self.sent = []
+        self.queues = []  # command queue of each command sent
+        self.responses = []
+
+    def send_binary(self, binary_data, command_queue_name, **properties):
+        correlation_id = 'id-{}'.format(next(self._ids))
+        self.sent.append(correlation_id)
+        self.queues.append(command_queue_name)
+        return correlation_id
+
+    def answer(self):
+        self.responses.extend(reversed(self.sent))
+        self.sent = []
+
+    def get(self, correlation_id=None, timeout=float('inf'), drain_events_timeout=0.005):
+        if not self.responses:
+            # Draining the connection waits for a response
+            time.sleep(drain_events_timeout)
+            if not self.responses:
+                return None
+        return FakeResponse(self.responses.pop(0))
+
+def make_helper(amqp, max_in_flight, command_queue_names='command_queue', **kwargs):
+    return InferenceHelper(amqp, command_queue_names, FakeQueue(), amqp, max_in_flight=max_in_flight, **kwargs)
+
+# --------------------------------------------------------------------------- #
+
+def test_futures_resolved_by_correlation_id():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=3)
+    helper.workers[0].latency = 0.01  # Measured: it has room for all its commands
+
+    async def run():
+        futures = [await helper.send(b'') for _ in range(3)]
+        assert helper.in_flight == 3
+        amqp.answer()
+        responses = await asyncio.gather(*futures)
+        return [r.msg.properties['correlation_id'] for r in responses]
+
+    assert loop.run_until_complete(run()) == ['id-0', 'id-1', 'id-2']
+    assert helper.in_flight == 0
+    helper.close()
+    loop.close()
+
+def test_in_flight_window():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=2)
+    helper.workers[0].latency = 0.01  # Measured: it has room for all its commands
+
+    async def run():
+        futures = [await helper.send(b'') for _ in range(2)]
+        blocked = asyncio.ensure_future(helper.send(b''))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert len(amqp.sent) == 2
+
+        amqp.answer()
+        await asyncio.gather(*futures)
+        future = await blocked
+        amqp.answer()
+        await future
+
+    loop.run_until_complete(run())
+    helper.close()
+    loop.close()
+
+def test_deadline():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=1)
+
+    async def run():
+        # No room in the worker queue before the deadline
+        future = await helper.send(b'', deadline=time.monotonic() + 0.02)
+        with pytest.raises(asyncio.TimeoutError):
+            await helper.send(b'', deadline=time.monotonic() + 0.01)
+
+        # Room once the first command is answered
+        second = asyncio.ensure_future(helper.send(b'', deadline=time.monotonic() + 0.1))
+        await asyncio.sleep(0.01)
+        amqp.answer()
+        await future
+        second = await second
+        amqp.answer()
+        response = await second
+        return response.msg.properties['correlation_id']
+
+    assert loop.run_until_complete(run()) == 'id-1'
+    helper.close()
+    loop.close()
+
+def test_dead_worker_capped():
+    # The dead worker never answers while the other one was measured
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=4, command_queue_names=['dead', 'alive'], timeout=10)
+
+    async def run():
+        dead, alive = await helper.send(b''), await helper.send(b'')
+        amqp.sent = [i for i, q in zip(amqp.sent, amqp.queues) if q == 'alive']
+        amqp.answer()
+        await alive
+
+        # The dead worker holds its single probe, the others go to the alive one up to its own room
+        amqp.queues = []
+        futures = [await helper.send(b'') for _ in range(4)]
+        assert amqp.queues == ['alive'] * 4
+        blocked = asyncio.ensure_future(helper.send(b''))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert [w.outstanding for w in helper.workers] == [1, 4]
+
+        amqp.sent = [i for i, q in zip(amqp.sent, amqp.queues) if q == 'alive']
+        amqp.answer()
+        await asyncio.gather(*futures)
+        await blocked
+        assert amqp.queues[-1] == 'alive'
+
+    loop.run_until_complete(run())
+    helper.close()
+    loop.close()
+
+def test_least_outstanding_routing():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=4, command_queue_names=['worker1', 'worker2'])
+
+    async def run():
+        # A single command to each worker until it answers
+        futures = [await helper.send(b'') for _ in range(2)]
+        blocked = asyncio.ensure_future(helper.send(b''))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert amqp.queues == ['worker1', 'worker2']
+        amqp.answer()
+        await asyncio.gather(*futures)
+        futures = [await blocked]
+        amqp.answer()
+        await asyncio.gather(*futures)
+
+        # Then by expected latency, up to `max_in_flight` commands per worker
+        helper.workers[0].latency, helper.workers[1].latency = 0.1, 0.02
+        amqp.queues = []
+        futures = [await helper.send(b'') for _ in range(6)]
+        assert amqp.queues == ['worker2'] * 4 + ['worker1'] * 2
+        amqp.answer()
+        await asyncio.gather(*futures)
+
+    loop.run_until_complete(run())
+    assert [w.outstanding for w in helper.workers] == [0, 0]
+    helper.close()
+    loop.close()
+
+def test_dead_worker_out_of_rotation():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    amqp = FakeAMQP()
+    helper = make_helper(amqp, max_in_flight=4, command_queue_names=['dead', 'alive'], timeout=0.02, retry_delay=10)
+
+    async def run():
+        dead, alive = await helper.send(b''), await helper.send(b'')
+        amqp.sent = [i for i, q in zip(amqp.sent, amqp.queues) if q == 'alive']
+        amqp.answer()
+        await alive
+        with pytest.raises(Exception):
+            await dead
+
+        amqp.queues = []
+        futures = [await helper.send(b'') for _ in range(3)]
+        assert amqp.queues == ['alive'] * 3
+        amqp.answer()
+        await asyncio.gather(*futures)
+
+    loop.run_until_complete(run())
+    assert not helper.workers[0].available(time.monotonic())
+    assert helper.workers[1].failures == 0
+    helper.close()
+    loop.close()
+
+def test_serialize_image_command():
+    image = bytes(range(256)) * 1000
+    serialized = Message()
+    serialized.ParseFromString(serialize_image_command(memoryview(image), create_workflow_command_mix(), 'response_queue'))
+
+    # Same as the command of the deepomatic RPC client, but for the random track id
+    expected = Message()
+    expected.ParseFromString(create_serialized_command(
+        create_images_input_mix([v07_ImageInput(source=b'data:image/*;binary,' + image)]),
+        create_workflow_command_mix(), forward_to=['response_queue']))
+    expected.command.base_info.track_id = serialized.command.base_info.track_id
+    assert serialized == expected
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from metrics import Registry, Counter, Gauge, Histogram
+
+# --------------------------------------------------------------------------- #
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = Counter('frames_total', 'Frames', ['stream'], registry=registry)
+    counter.labels('cam1').inc()
+    counter.labels('cam1').inc(2)
+    counter.labels('cam"2').inc()
+    gauge = Gauge('in_flight', 'In flight', registry=registry)
+    gauge.set_function(lambda: 3)
+
+    assert registry.render().splitlines() == [
+        '# HELP frames_total Frames',
+        '# TYPE frames_total counter',
+        'frames_total{stream="cam1"} 3.0',
+        'frames_total{stream="cam\\"2"} 1.0',
+        '# HELP in_flight In flight',
+        '# TYPE in_flight gauge',
+        'in_flight 3.0',
+    ]
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram('latency_seconds', 'Latency', ['stage'], buckets=[0.1, 1.], registry=registry)
+    for value in [0.05, 0.1, 0.5, 2.]:
+        histogram.labels('draw').observe(value)
+    with histogram.labels('publish').time():
+        pass
+
+    lines = registry.render().splitlines()
+    assert lines[2:7] == [
+        'latency_seconds_bucket{stage="draw",le="0.1"} 2.0',
+        'latency_seconds_bucket{stage="draw",le="1.0"} 3.0',
+        'latency_seconds_bucket{stage="draw",le="+Inf"} 4.0',
+        'latency_seconds_sum{stage="draw"} 2.65',
+        'latency_seconds_count{stage="draw"} 4.0',
+    ]
+    assert lines[-1] == 'latency_seconds_count{stage="publish"} 1.0'
+
+def test_invalid_metrics():
+    registry = Registry()
+    counter = Counter('frames_total', 'Frames', ['stream'], registry=registry)
+    with pytest.raises(Exception):
+        counter.labels()
+    with pytest.raises(Exception):
+        Counter('frames_total', 'Frames', registry=registry)
+
+def test_scrape_endpoint():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    registry = Registry()
+    Counter('frames_total', 'Frames', registry=registry).inc()
+
+    async def scrape(path):
+        server = await registry.serve(0, host='127.0.0.1')
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response.decode()
+
+    response = loop.run_until_complete(scrape('/metrics'))
+    assert response.startswith('HTTP/1.0 200 OK')
+    assert response.endswith('frames_total 1.0\n')
+    assert loop.run_until_complete(scrape('/other')).startswith('HTTP/1.0 404')
+    loop.close()
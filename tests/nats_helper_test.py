@@ -0,0 +1,190 @@
+import asyncio
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from nats_helper import IngressQueue, NATSHelper
+from proto import xi_iot_pb2
+
+# --------------------------------------------------------------------------- #
+
+def drain(queue):
+    loop = asyncio.new_event_loop()
+    items = []
+    while len(queue):
+        items.append(loop.run_until_complete(queue.get()))
+    loop.close()
+    return items
+
+def test_unbounded_never_drops():
+    queue = IngressQueue()
+    for i in range(100):
+        queue.put('cam', i)
+    assert queue.dropped == 0
+    assert drain(queue) == list(range(100))
+
+def test_drop_oldest():
+    queue = IngressQueue(3, IngressQueue.DROP_OLDEST)
+    for i in range(5):
+        queue.put('cam', i)
+    assert queue.received == 5
+    assert queue.dropped == 2
+    assert drain(queue) == [2, 3, 4]
+
+def test_drop_newest():
+    queue = IngressQueue(3, IngressQueue.DROP_NEWEST)
+    for i in range(5):
+        queue.put('cam', i)
+    assert queue.dropped == 2
+    assert drain(queue) == [0, 1, 2]
+
+def test_latest_per_stream():
+    queue = IngressQueue(0, IngressQueue.LATEST)
+    for i in range(5):
+        queue.put('cam1', i)
+        queue.put('cam2', 10 + i)
+    assert queue.dropped_by_stream == {'cam1': 4, 'cam2': 4}
+    assert drain(queue) == [4, 14]
+
+def test_latest_bounded_streams():
+    queue = IngressQueue(2, IngressQueue.LATEST)
+    queue.put('cam1', 1)
+    queue.put('cam2', 2)
+    queue.put('cam3', 3)
+    assert queue.dropped_by_stream == {'cam1': 1}
+    assert drain(queue) == [2, 3]
+
+def test_unknown_policy():
+    with pytest.raises(Exception):
+        IngressQueue(1, 'random')
+
+# --------------------------------------------------------------------------- #
+
+class FakeMessage(object):
+    def __init__(self, payload):
+        self.data = NATSHelper.message_from_payload(payload)
+
+    @classmethod
+    def from_message(cls, message):
+        msg = cls(b'')
+        msg.data = message.SerializeToString()
+        return msg
+
+def test_parse_topics():
+    topics = NATSHelper.parse_topics(' cam1:out1, cam2:out2,')
+    assert list(topics.items()) == [('cam1', 'out1'), ('cam2', 'out2')]
+    assert NATSHelper.parse_topics([('cam1', 'out1')]) == {'cam1': 'out1'}
+    for invalid in ['cam1', 'cam1:out1:x', 'cam1:', 'cam1:out1,cam1:out2', '']:
+        with pytest.raises(Exception):
+            NATSHelper.parse_topics(invalid)
+
+def test_single_stream_topics():
+    helper = NATSHelper(nats_broker_url='nats://localhost:4222', nats_src_topic='cam', nats_dst_topic='out')
+    assert list(helper.topics.items()) == [('cam', 'out')]
+
+def test_streams_dispatched_with_their_topic():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    helper = NATSHelper(nats_broker_url='nats://localhost:4222', nats_topics='cam1:out1,cam2:out2')
+    assert (helper.nats_src_topic, helper.nats_dst_topic) == ('cam1', 'out1')
+
+    for i in range(3):
+        for topic in helper.topics:
+            helper.ingress_queue.put(topic, (topic, FakeMessage('{}-{}'.format(topic, i).encode()), 0.))
+
+    received = []
+    async def message_handler(payload, topic, source, received_at):
+        received.append((topic, bytes(payload).decode()))
+        if len(received) == 6:
+            task.cancel()
+
+    task = loop.create_task(helper.process_ingress_queue(message_handler))
+    with pytest.raises(asyncio.CancelledError):
+        loop.run_until_complete(task)
+    assert [p for t, p in received if t == 'cam1'] == ['cam1-0', 'cam1-1', 'cam1-2']
+    assert [p for t, p in received if t == 'cam2'] == ['cam2-0', 'cam2-1', 'cam2-2']
+    loop.close()
+
+def test_streams_split_between_replicas():
+    topics = ','.join('cam{i}:out{i}'.format(i=i) for i in range(20))
+    subscribed = []
+    for replica_index in range(3):
+        helper = NATSHelper(nats_broker_url='nats://localhost:4222', nats_topics=topics, replicas=3, replica_index=replica_index)
+        subscribed.extend(helper.subscribed_topics)
+    assert sorted(subscribed) == sorted(helper.topics)
+    with pytest.raises(Exception):
+        NATSHelper(nats_broker_url='nats://localhost:4222', nats_topics=topics, replicas=3, replica_index=3)
+
+def test_replica_index_from_hostname(monkeypatch):
+    monkeypatch.delenv('REPLICA_INDEX', raising=False)
+    monkeypatch.setattr('socket.gethostname', lambda: 'deepomatic-app-2')
+    assert NATSHelper.get_replica_index() == 2
+    monkeypatch.setattr('socket.gethostname', lambda: 'deepomatic-app')
+    with pytest.raises(Exception):
+        NATSHelper.get_replica_index()
+    monkeypatch.setenv('REPLICA_INDEX', '1')
+    assert NATSHelper.get_replica_index() == 1
+
+class FakeNATS(object):
+    def __init__(self):
+        self.subscriptions = []
+
+    async def connect(self, url, loop=None):
+        pass
+
+    async def subscribe(self, subject, queue='', cb=None):
+        self.subscriptions.append((subject, queue))
+        return len(self.subscriptions)
+
+def test_queue_group_subscription():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    helper = NATSHelper(nats_broker_url='nats://localhost:4222', nats_topics='cam1:out1,cam2:out2', nats_queue_group='runtime')
+    helper.nats_client = FakeNATS()
+
+    async def message_handler(payload, topic, source, received_at):
+        pass
+
+    loop.run_until_complete(helper.connect(loop, message_handler))
+    assert helper.nats_client.subscriptions == [('cam1', 'runtime'), ('cam2', 'runtime')]
+    helper._ingress_task.cancel()
+    helper._ingress_task = None
+    helper.subscribe_ids = []
+    helper.connected = False
+    loop.close()
+
+def test_source_message_carried_to_output():
+    source = xi_iot_pb2.DataStreamMessage()
+    source.timestamp = 1546300800000000000
+    source.metaData.topic = 'cam1'
+    source.payload = b'image'
+
+    payload, received = NATSHelper.payload_from_message(FakeMessage.from_message(source))
+    assert payload == b'image'
+    assert received.payload == b''
+
+    output = xi_iot_pb2.DataStreamMessage()
+    output.ParseFromString(NATSHelper.message_from_payload(b'result', received))
+    assert output.timestamp == source.timestamp
+    assert output.metaData.topic == 'cam1'
+    assert output.payload == b'result'
+
+def test_payload_not_copied():
+    source = xi_iot_pb2.DataStreamMessage(timestamp=42, payload=b'\xff\xd8' * 100000)
+    source.metaData.topic = 'cam1'
+    msg = FakeMessage.from_message(source)
+
+    payload, received = NATSHelper.payload_from_message(msg)
+    assert isinstance(payload, memoryview)
+    assert payload.obj is msg.data
+    assert payload == source.payload
+    assert received.timestamp == 42 and received.metaData.topic == 'cam1'
+
+    payload, _ = NATSHelper.payload_from_message(FakeMessage.from_message(xi_iot_pb2.DataStreamMessage(timestamp=1)))
+    assert payload == b''
+
+    with pytest.raises(Exception):
+        msg.data = msg.data[:-10]
+        NATSHelper.payload_from_message(msg)
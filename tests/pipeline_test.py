@@ -0,0 +1,166 @@
+import asyncio
+import os
+import sys
+import json
+import time
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from main import Config, MessageHandler
+import metrics
+from nats_helper import NATSHelper
+from proto import xi_iot_pb2
+from fakes import FakeWorker, InMemoryNATS, make_detection_payload
+from draw_test import read_test_image
+
+# --------------------------------------------------------------------------- #
+
+TOPICS = {'cam1': 'out1', 'cam2': 'out2'}
+
+@pytest.fixture
+def env(monkeypatch):
+    for var in ['DRAW_DEMO', 'TARGET_INFERENCE_FPS', 'INFERENCE_MAX_SIZE', 'CROP_ASPECT_RATIO', 'OUTPUT_FORMAT', 'NATS_TOPICS', 'RESULT_CACHE_SIZE', 'MOTION_THRESHOLD', 'TRACK_BOXES', 'FRAME_DEADLINE_MS', 'MAX_IN_FLIGHT_REQUESTS']:
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setenv('PROCESS_EACH_N_FRAMES', '2')
+    return monkeypatch
+
+def run_pipeline(worker, n_frames, topics=TOPICS, interval=0., latencies=None):
+    """
+    Send `n_frames` frames on each stream through the runtime, one every `interval` seconds,
+    return the received messages by destination topic. The time from the publication of each
+    frame to the reception of its result is appended to `latencies`, if given.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = InMemoryNATS()
+
+    nats_helper = NATSHelper(nats_broker_url='nats://fake:4222', nats_topics=list(topics.items()))
+    nats_helper.nats_client = broker.client()
+    handler = MessageHandler(Config(amqp_client=worker), nats_helper)
+
+    producer = broker.client()
+    received = {topic: [] for topic in topics.values()}
+    sent_at = {}
+    done = asyncio.Event()
+
+    def make_cb(topic):
+        async def cb(msg):
+            message = xi_iot_pb2.DataStreamMessage()
+            message.ParseFromString(msg.data)
+            received[topic].append(message)
+            if latencies is not None:
+                latencies.append(time.monotonic() - sent_at[message.timestamp])
+            # Frames are published in order, those which failed are not
+            if all(r and r[-1].timestamp == n_frames for r in received.values()):
+                done.set()
+        return cb
+
+    async def run():
+        await nats_helper.connect(loop, handler.message_handler)
+        await producer.connect()
+        for topic in topics.values():
+            await producer.subscribe(topic, cb=make_cb(topic))
+        image = read_test_image('dog.jpg')
+        for i in range(n_frames):
+            sent_at[i + 1] = time.monotonic()
+            for src_topic in topics:
+                message = xi_iot_pb2.DataStreamMessage(timestamp=i + 1, payload=image)
+                await producer.publish(src_topic, message.SerializeToString())
+            await asyncio.sleep(interval)
+        await asyncio.wait_for(done.wait(), 10)
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        handler.close()
+        loop.run_until_complete(producer.close())
+        loop.close()
+    return received
+
+def test_pipeline_json(env):
+    payload = make_detection_payload(3)
+    worker = FakeWorker(latency=0.01, jitter=0.005, concurrency=2, payloads=[payload])
+    received = run_pipeline(worker, 10)
+
+    assert worker.commands == 10
+    for messages in received.values():
+        # Published in order with the source timestamp
+        assert [m.timestamp for m in messages] == list(range(1, 11))
+        result = json.loads(messages[0].payload.decode('utf8'))
+        bboxes = [p['roi']['bbox'] for p in result['outputs'][0]['labels']['predicted']]
+        expected = [p['roi']['bbox'] for p in payload['outputs'][0]['labels']['predicted']]
+        assert [pytest.approx(b, abs=1e-6) for b in bboxes] == expected
+
+def test_pipeline_draw(env):
+    env.setenv('DRAW_DEMO', '1')
+    env.setenv('CROP_ASPECT_RATIO', '1')
+    received = run_pipeline(FakeWorker(latency=0.005), 4)
+    for messages in received.values():
+        assert [m.timestamp for m in messages] == [1, 2, 3, 4]
+        assert all(m.payload.startswith(b'\xff\xd8') for m in messages)
+
+def test_pipeline_result_cache(env):
+    # The same frame is sent again and again: only the first one of each stream is inferred
+    env.setenv('PROCESS_EACH_N_FRAMES', '1')
+    env.setenv('RESULT_CACHE_SIZE', '4')
+    worker = FakeWorker(latency=0.005)
+    received = run_pipeline(worker, 5)
+    assert worker.commands == len(TOPICS)
+    for messages in received.values():
+        assert [m.timestamp for m in messages] == [1, 2, 3, 4, 5]
+        assert len(set(m.payload for m in messages)) == 1
+
+def test_pipeline_motion_gate(env):
+    env.setenv('PROCESS_EACH_N_FRAMES', '1')
+    env.setenv('MOTION_THRESHOLD', '2')
+    worker = FakeWorker(latency=0.005)
+    received = run_pipeline(worker, 5)
+    assert worker.commands == len(TOPICS)
+    for messages in received.values():
+        assert [m.timestamp for m in messages] == [1, 2, 3, 4, 5]
+
+def test_pipeline_tracking(env):
+    env.setenv('TRACK_BOXES', '1')
+    payloads = [make_detection_payload(2, seed=0) for _ in range(2)]
+    for p in payloads[1]['outputs'][0]['labels']['predicted']:
+        p['roi']['bbox']['xmin'] += 0.02
+        p['roi']['bbox']['xmax'] += 0.02
+    worker = FakeWorker(latency=0.005, payloads=payloads)
+    received = run_pipeline(worker, 4, topics={'cam1': 'out1'})
+
+    xmin = payloads[0]['outputs'][0]['labels']['predicted'][0]['roi']['bbox']['xmin']
+    for messages in received.values():
+        results = [json.loads(m.payload.decode('utf8')) for m in messages]
+        xmins = [r['outputs'][0]['labels']['predicted'][0]['roi']['bbox']['xmin'] for r in results]
+        assert xmins == pytest.approx([xmin, xmin, xmin + 0.02, xmin + 0.03], abs=1e-6)
+
+def test_pipeline_deadline(env):
+    # The worker is slower than the deadline: each frame is published by its deadline with the last result received
+    env.setenv('PROCESS_EACH_N_FRAMES', '1')
+    env.setenv('FRAME_DEADLINE_MS', '100')
+    env.setenv('MAX_IN_FLIGHT_REQUESTS', '1')
+    expired = metrics.FRAMES_EXPIRED.total()
+    payloads = [make_detection_payload(1, seed=i) for i in range(8)]
+    worker = FakeWorker(latency=0.25, payloads=payloads)
+    latencies = []
+    received = run_pipeline(worker, 20, topics={'cam1': 'out1'}, interval=0.05, latencies=latencies)
+
+    assert metrics.FRAMES_EXPIRED.total() > expired
+    assert max(latencies) < 0.1 + 0.05
+    for messages in received.values():
+        # The first frames expired before any result, the others got the last result again
+        timestamps = [m.timestamp for m in messages]
+        assert timestamps == list(range(timestamps[0], 21))
+        assert timestamps[0] > 1
+        assert len(set(m.payload for m in messages)) < len(messages)
+
+def test_fake_worker_latency():
+    worker = FakeWorker(latency=0.02, concurrency=1)
+    ids = [worker.send_binary(b'', 'queue', reply_to='response_queue') for _ in range(2)]
+    assert worker.get(timeout=None) is None
+    first = worker.get(timeout=1)
+    assert first.msg.properties['correlation_id'] == ids[0]
+    # The second command waits for the first one to be processed
+    assert worker.get(timeout=None) is None
+    assert worker.get(correlation_id=ids[1], timeout=1).to_result_buffer().HasField('v07_recognition')
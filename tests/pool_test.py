@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sys
+import io
+import threading
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from pool import WorkerPool
+from frame import prepare_inference_data
+from draw_test import read_test_image
+
+# --------------------------------------------------------------------------- #
+
+def thread_name(*args):
+    return threading.current_thread().name, args
+
+def run(pool, coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        pool.close()
+        loop.close()
+
+def test_runs_on_the_event_loop_without_workers():
+    pool = WorkerPool()
+    assert pool.size == 1
+    main_thread = threading.current_thread().name
+
+    async def jobs():
+        return [await pool.run_in_thread(thread_name, 1), await pool.run_in_process(thread_name, 2)]
+
+    assert run(pool, jobs()) == [(main_thread, (1,)), (main_thread, (2,))]
+
+def test_threads_keep_the_order_of_the_results():
+    pool = WorkerPool(n_threads=4)
+    main_thread = threading.current_thread().name
+
+    async def jobs():
+        return await asyncio.gather(*[pool.run_in_process(thread_name, i) for i in range(8)])
+
+    results = run(pool, jobs())
+    assert [args for _, args in results] == [(i,) for i in range(8)]
+    assert all(name != main_thread for name, _ in results)
+
+def test_processes():
+    pool = WorkerPool(n_processes=2)
+    assert pool.size == 2
+    data = read_test_image('screenshot.jpg')
+
+    async def jobs():
+        return await asyncio.gather(*[pool.run_in_process(prepare_inference_data, data, 100 + i) for i in range(4)])
+
+    results = run(pool, jobs())
+    assert [max(Image.open(io.BytesIO(image)).size) for image, _ in results] == [100, 101, 102, 103]
+    assert all(change_of_basis_matrix is None for _, change_of_basis_matrix in results)
@@ -0,0 +1,66 @@
+"""
+Reference implementations of the aspect ratio crop with PIL, allocating intermediate
+images, to check and benchmark the array-backed ones of utils against
+"""
+import numpy as np
+from PIL import Image, ImageOps
+
+# --------------------------------------------------------------------------- #
+
+def pil_crop_V_pad_H(image, w, h):
+    W, H = image.size
+    ymin = int((H - h) / 2)
+    ymax = ymin + h
+    assert ymin >= 0
+    assert ymax <= H
+
+    offset = int((w - W) / 2)
+    rest = w - W - offset
+    assert offset >= 0
+    assert rest >= 0
+
+    new_image = Image.new('RGB', (w, h))
+    image = image.crop((0, ymin, W, ymax))
+    assert (W, h) == image.size
+
+    new_image.paste(ImageOps.mirror(image.crop((0, 0, offset, h))), (0, 0))
+    new_image.paste(image, (offset, 0))
+    new_image.paste(ImageOps.mirror(image.crop((W - rest, 0, W, h))), (offset + W, 0))
+
+    # Compute new coordinate system for bboxes
+    change_of_basis_matrix = np.array([
+        [1, 0, offset],
+        [0, 1,  -ymin],
+        [0, 0,      1]
+    ])
+
+    return new_image, change_of_basis_matrix
+
+def pil_crop_H_pad_V(image, w, h):
+    W, H = image.size
+    xmin = int((W - w) / 2)
+    xmax = xmin + w
+    assert xmin >= 0
+    assert xmax <= W
+
+    offset = int((h - H) / 2)
+    rest = h - H - offset
+    assert offset >= 0
+    assert rest >= 0
+
+    new_image = Image.new('RGB', (w, h))
+    image = image.crop((xmin, 0, xmax, H))
+    assert (w, H) == image.size
+
+    new_image.paste(ImageOps.flip(image.crop((0, 0, w, offset))), (0, 0))
+    new_image.paste(image, (0, offset))
+    new_image.paste(ImageOps.flip(image.crop((0, H - rest, w, H))), (0, offset + H))
+
+    # Compute new coordinate system for bboxes
+    change_of_basis_matrix = np.array([
+        [1, 0,  -xmin],
+        [0, 1, offset],
+        [0, 0,      1]
+    ])
+
+    return new_image, change_of_basis_matrix
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import numpy as np
+from PIL import ImageEnhance
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+import utils
+from frame import Frame
+from result_cache import ResultCache, difference_hash, hamming_distance
+from draw_test import read_test_image
+
+# --------------------------------------------------------------------------- #
+
+def get_hash(data, cache=ResultCache()):
+    return cache.get_hash(Frame(data))
+
+def test_difference_hash():
+    thumbnail = np.array([[0, 1, 0], [2, 1, 3]], dtype=np.uint8)
+    assert difference_hash(thumbnail) == 0b1001 << 4
+    assert hamming_distance(0b1011, 0b0110) == 3
+
+def test_near_duplicates_hash():
+    image = utils.load(read_test_image('dog.jpg'))
+    brighter = ImageEnhance.Brightness(image).enhance(1.1)
+    other = utils.load(read_test_image('screenshot.jpg'))
+
+    reference = get_hash(utils.dump(image))
+    assert reference.bit_length() <= 64
+    assert hamming_distance(reference, get_hash(utils.dump(brighter))) <= 4
+    assert hamming_distance(reference, get_hash(utils.dump(other))) > 16
+
+def test_decoded_frame_hash():
+    data = read_test_image('dog.jpg')
+    frame = Frame(data)
+    frame.image  # Hashed from the decoded pixels
+    assert hamming_distance(get_hash(data), ResultCache().get_hash(frame)) <= 4
+
+def test_get_nearest():
+    cache = ResultCache(max_size=4, max_distance=2)
+    cache.put(0b0000, 'a', now=0)
+    cache.put(0b0111, 'b', now=0)
+    assert cache.get(0b0001, now=1) == 'a'
+    assert cache.get(0b0110, now=1) == 'b'
+    assert cache.get(0b1111000, now=1) is None
+
+def test_ttl():
+    cache = ResultCache(max_distance=0, ttl=10)
+    cache.put(1, 'a', now=0)
+    assert cache.get(1, now=10) == 'a'
+    assert cache.get(1, now=10.5) is None
+    assert len(cache) == 0
+
+def test_least_recently_used_evicted():
+    cache = ResultCache(max_size=2, max_distance=0)
+    cache.put(1, 'a', now=0)
+    cache.put(2, 'b', now=0)
+    assert cache.get(1, now=0) == 'a'
+    cache.put(3, 'c', now=0)
+    assert len(cache) == 2
+    assert cache.get(2, now=0) is None
+    assert cache.get(1, now=0) == 'a'
+
+def test_failed_result_evicted():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cache = ResultCache(max_distance=0)
+    pending, failed = loop.create_future(), loop.create_future()
+    failed.set_exception(Exception('No response'))
+    cache.put(1, pending, now=0)
+    cache.put(2, failed, now=0)
+    assert cache.get(1, now=0) is pending
+    assert cache.get(2, now=0) is None
+    assert len(cache) == 1
+    loop.close()
@@ -0,0 +1,69 @@
+import os
+import sys
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+import utils
+from frame import Frame
+from sampler import FixedFrameSampler, AdaptiveFrameSampler, MotionGate
+
+# --------------------------------------------------------------------------- #
+
+def sample(sampler, n, fps, t0=0):
+    return [sampler.should_process(t0 + i / fps) for i in range(n)]
+
+def test_fixed_sampler():
+    sampler = FixedFrameSampler(3)
+    assert [sampler.should_process() for _ in range(7)] == [True, False, False, True, False, False, True]
+
+def test_adaptive_reaches_target_fps():
+    sampler = AdaptiveFrameSampler(target_fps=5, latency_budget=1)
+    sampler.record_round_trip(0.05)
+    decisions = sample(sampler, 300, fps=30)
+    assert sampler.n_frames == 6
+    assert sum(decisions[-60:]) == 10
+
+def test_adaptive_limited_by_worker():
+    sampler = AdaptiveFrameSampler(target_fps=30, latency_budget=1, max_in_flight=2)
+    for _ in range(10):
+        sampler.record_round_trip(0.4)
+    sample(sampler, 100, fps=30)
+    assert sampler.n_frames == 6  # 0.4s / 2 commands in flight
+
+def test_adaptive_backs_off_over_budget():
+    sampler = AdaptiveFrameSampler(target_fps=10, latency_budget=0.2, max_n_frames=30)
+    for _ in range(20):
+        sampler.record_round_trip(0.5)
+    sample(sampler, 100, fps=30)
+    assert sampler.n_frames == 30
+
+    for _ in range(200):
+        sampler.record_round_trip(0.01)
+    sample(sampler, 100, fps=30, t0=100)
+    assert sampler.n_frames == 3
+
+def test_adaptive_bounds():
+    sampler = AdaptiveFrameSampler(target_fps=100, latency_budget=1, min_n_frames=2)
+    sample(sampler, 100, fps=30)
+    assert sampler.n_frames == 2
+
+def make_frame(box=None):
+    image = Image.new('RGB', (320, 240), (80, 80, 80))
+    if box is not None:
+        ImageDraw.Draw(image).rectangle(box, fill=(255, 255, 255))
+    return Frame(utils.dump(image))
+
+def test_motion_gate():
+    gate = MotionGate(threshold=5, max_staleness=10)
+    assert gate.should_process(make_frame(), now=0)
+    assert not gate.should_process(make_frame(), now=1)
+    # A small object appears: compared with the last processed frame, not the previous one
+    assert not gate.should_process(make_frame((0, 0, 20, 20)), now=2)
+    assert gate.should_process(make_frame((0, 0, 120, 120)), now=3)
+    assert not gate.should_process(make_frame((0, 0, 120, 120)), now=4)
+    assert gate.should_process(make_frame(), now=5)
+
+def test_motion_gate_max_staleness():
+    gate = MotionGate(threshold=5, max_staleness=10)
+    assert [gate.should_process(make_frame(), now=t) for t in range(0, 25, 5)] == [True, False, True, False, True]
@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from serializer import InferenceResult, ResultSerializer
+from draw_test import detection_payload
+
+# --------------------------------------------------------------------------- #
+
+def make_result(proto_result=None):
+    return InferenceResult(json.loads(json.dumps(detection_payload['outputs'])), proto_result)
+
+def test_json_cached():
+    serializer = ResultSerializer(ResultSerializer.JSON)
+    result = make_result()
+    payload = serializer.serialize(result)
+    assert json.loads(payload.decode('utf8')) == detection_payload
+    assert serializer.serialize(result) is payload
+
+def test_plain_dict():
+    serializer = ResultSerializer(ResultSerializer.JSON)
+    assert json.loads(serializer.serialize(detection_payload).decode('utf8')) == detection_payload
+
+def test_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    serializer = ResultSerializer(ResultSerializer.MSGPACK)
+    result = make_result()
+    payload = serializer.serialize(result)
+    assert msgpack.unpackb(payload, raw=False) == detection_payload
+    assert serializer.serialize(result) is payload
+
+def test_protobuf():
+    Result_pb2 = pytest.importorskip('deepomatic.rpc.buffers.protobuf.nn.Result_pb2')
+    proto_result = Result_pb2.Result()
+    prediction = proto_result.v07_recognition.outputs.add().labels.predicted.add()
+    prediction.label_name = 'sunglasses'
+    prediction.roi.bbox.xmin = 0.9
+
+    # Normalized boxes are copied back to the protobuf result
+    result = make_result(proto_result)
+    payload = ResultSerializer(ResultSerializer.PROTOBUF).serialize(result)
+    bbox = Result_pb2.Result.FromString(payload).v07_recognition.outputs[0].labels.predicted[0].roi.bbox
+    assert bbox.xmin == pytest.approx(0.312604159)
+    assert bbox.ymax == pytest.approx(0.5318923)
+
+def test_unknown_format():
+    with pytest.raises(Exception):
+        ResultSerializer('xml')
@@ -0,0 +1,40 @@
+import os
+import sys
+import json
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+import tracing
+
+# --------------------------------------------------------------------------- #
+
+def test_tracer_sample_rate():
+    assert tracing.Tracer(0.).start('cam') is None
+    trace = tracing.Tracer(1.).start('cam', 1546300800000000000)
+    assert trace.stream == 'cam'
+    assert trace.timestamp == 1546300800000000000
+
+def test_stage_spans():
+    trace = tracing.Trace('cam', int(time.time() * 1e9))
+    stage = tracing.Stage('test_stage')
+    count = stage.latency.count
+    with stage.time(trace):
+        time.sleep(0.01)
+    with stage.time():
+        pass
+    assert stage.latency.count == count + 2
+
+    trace = json.loads(json.dumps(trace.to_dict()))
+    assert [span['stage'] for span in trace['spans']] == ['test_stage']
+    assert trace['spans'][0]['duration'] >= 0.01
+    assert trace['duration'] >= trace['spans'][0]['start'] + trace['spans'][0]['duration']
+    assert trace['capture_delay'] >= 0
+
+def test_frame_latency():
+    count = tracing.FRAME_LATENCY._child.count
+    tracing.record_frame_latency(0)
+    assert tracing.FRAME_LATENCY._child.count == count
+    tracing.record_frame_latency(int((time.time() - 0.5) * 1e9))
+    assert tracing.FRAME_LATENCY._child.count == count + 1
+    assert tracing.FRAME_LATENCY._child.sum >= 0.5
@@ -0,0 +1,67 @@
+import os
+import sys
+import copy
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'runtime'))
+
+from serializer import InferenceResult
+from tracker import Tracks, iou_matrix, match_predictions
+from fakes import make_proto_result
+
+# --------------------------------------------------------------------------- #
+
+def make_result(boxes, label_ids=None):
+    predicted = []
+    for i, (xmin, ymin, xmax, ymax) in enumerate(boxes):
+        predicted.append({
+            'label_id': 0 if label_ids is None else label_ids[i],
+            'label_name': 'car',
+            'score': 0.9,
+            'roi': {'region_id': i + 1, 'bbox': {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}},
+        })
+    outputs = [{'labels': {'predicted': predicted, 'discarded': []}}]
+    return InferenceResult(outputs, make_proto_result({'outputs': copy.deepcopy(outputs)}))
+
+def get_boxes(result):
+    return [p['roi']['bbox'][k] for p in result['outputs'][0]['labels']['predicted'] for k in ('xmin', 'ymin', 'xmax', 'ymax')]
+
+def test_iou_matrix():
+    ious = iou_matrix(np.array([[0, 0, 0.2, 0.2]]), np.array([[0, 0, 0.2, 0.2], [0.1, 0, 0.3, 0.2], [0.5, 0.5, 0.6, 0.6]]))
+    assert ious.ravel().tolist() == pytest.approx([1, 1 / 3, 0])
+
+def test_match_predictions():
+    previous = make_result([(0, 0, 0.2, 0.2), (0.5, 0.5, 0.7, 0.7)], label_ids=[0, 1])
+    current = make_result([(0.52, 0.5, 0.72, 0.7), (0.02, 0, 0.22, 0.2), (0.55, 0.5, 0.75, 0.7)], label_ids=[1, 0, 0])
+    matches = match_predictions(previous['outputs'][0]['labels']['predicted'], current['outputs'][0]['labels']['predicted'], 0.3)
+    assert sorted(matches) == [(0, 1), (1, 0)]
+
+def test_constant_velocity():
+    previous = make_result([(0.1, 0.1, 0.3, 0.3), (0.6, 0.6, 0.7, 0.7)])
+    current = make_result([(0.2, 0.1, 0.4, 0.3), (0.2, 0.8, 0.3, 0.9)])
+    tracks = Tracks(current, 10, previous, 5)
+
+    assert tracks.predict(10) is current
+    predicted = tracks.predict(12)
+    # The matched box keeps moving, the new one stays still
+    assert get_boxes(predicted) == pytest.approx([0.24, 0.1, 0.44, 0.3, 0.2, 0.8, 0.3, 0.9])
+    # No further than one interval between inferences, nor out of the image
+    assert get_boxes(tracks.predict(100))[:4] == pytest.approx([0.3, 0.1, 0.5, 0.3])
+    assert get_boxes(current)[:4] == pytest.approx([0.2, 0.1, 0.4, 0.3])
+
+def test_clipped():
+    tracks = Tracks(make_result([(0.75, 0, 0.95, 0.2)]), 1, make_result([(0.65, 0, 0.85, 0.2)]), 0)
+    assert get_boxes(tracks.predict(2)) == pytest.approx([0.85, 0, 1, 0.2])
+
+def test_without_previous_result():
+    current = make_result([(0.2, 0.1, 0.4, 0.3)])
+    tracks = Tracks(current, 3)
+    assert not tracks.moving
+    assert tracks.predict(5) is current
+
+def test_protobuf_result_not_shared():
+    current = make_result([(0.2, 0.1, 0.4, 0.3)])
+    predicted = Tracks(current, 1, make_result([(0.1, 0.1, 0.3, 0.3)]), 0).predict(2)
+    assert predicted.proto_result is not current.proto_result
+    assert predicted.proto_result == current.proto_result